@@ -0,0 +1,117 @@
+from functools import lru_cache
+from hashlib import sha256
+from glob import glob
+from os import getenv, makedirs, path, remove, replace, utime
+from tempfile import NamedTemporaryFile
+from typing import List, Tuple, Optional
+import pickle
+
+from rtl import RTL
+from rtl.value import RegisterTable
+
+CHUNK_SIZE: int = 1 << 20
+# Entries kept in the cache directory, the least recently used go first
+MAX_ENTRIES: int = 16
+
+Function = Tuple[str, RegisterTable, List[RTL]]
+
+
+def cache_dir(
+) -> str:
+    cache_home: str = getenv(
+        "XDG_CACHE_HOME",
+        path.join(path.expanduser("~"), ".cache")
+    )
+
+    return getenv("RTL_CACHE_DIR", path.join(cache_home, "trace-scheduling"))
+
+
+# Digest of the tool's own sources, so an entry pickled by any other
+# version of the IR classes is never read back, computed on first use
+@lru_cache(maxsize=None)
+def source_digest(
+) -> bytes:
+    digest = sha256()
+    src_dir: str = path.dirname(path.dirname(path.abspath(__file__)))
+
+    for source in sorted(glob(path.join(src_dir, "**", "*.py"), recursive=True)):
+        digest.update(path.relpath(source, src_dir).encode())
+        with open(source, "rb") as f:
+            digest.update(f.read())
+
+    return digest.digest()
+
+
+# Key of the parsed IR of a dump, from its contents and the tool's sources
+def cache_key(
+    in_file: str
+) -> str:
+    digest = sha256(source_digest())
+
+    with open(in_file, "rb") as f:
+        chunk: bytes = f.read(CHUNK_SIZE)
+        while len(chunk) > 0:
+            digest.update(chunk)
+            chunk = f.read(CHUNK_SIZE)
+
+    return digest.hexdigest()
+
+
+def cache_file(
+    key: str
+) -> str:
+    return path.join(cache_dir(), key + ".ir")
+
+
+# Returns the cached functions of the dump or None on a miss
+def load(
+    key: str
+) -> Optional[List[Function]]:
+    functions: Optional[List[Function]] = None
+
+    try:
+        with open(cache_file(key), "rb") as f:
+            functions = pickle.load(f)
+        utime(cache_file(key))
+    # An entry that cannot be unpickled for any reason is just a miss
+    except (
+        OSError, EOFError, pickle.UnpicklingError, AttributeError,
+        ImportError, TypeError, ValueError, IndexError
+    ):
+        functions = None
+
+    return functions
+
+
+def store(
+    key: str, 
+    functions: List[Function]
+) -> None:
+    try:
+        makedirs(cache_dir(), exist_ok=True)
+        # Write then rename so a concurrent run never reads a partial entry
+        with NamedTemporaryFile(
+            "wb", dir=cache_dir(), suffix=".tmp", delete=False
+        ) as f:
+            pickle.dump(functions, f, pickle.HIGHEST_PROTOCOL)
+        replace(f.name, cache_file(key))
+        prune()
+    except OSError:
+        pass
+
+
+# Drops all but the MAX_ENTRIES most recently used entries
+def prune(
+) -> None:
+    entries: List[str] = sorted(
+        glob(path.join(cache_dir(), "*.ir")),
+        key=path.getmtime,
+        reverse=True
+    )
+
+    entry: str
+    for entry in entries[MAX_ENTRIES : ]:
+        try:
+            remove(entry)
+        except OSError:
+            pass
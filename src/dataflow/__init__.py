@@ -0,0 +1,247 @@
+from enum import Enum
+from heapq import heapify, heappop, heappush
+from typing import Dict, List, Optional, Set, Tuple
+
+from graph import *
+from rtl import *
+from rtl.value import *
+
+# A bit vector problem over the blocks of a CFG, each block summarized by
+# the facts it generates and the facts it kills
+class Problem:
+
+    class Direction(Enum):
+        FORWARD = 0
+        BACKWARD = 1
+
+    __slots__ = ("direction", "may", "gen", "kill", "boundary", "top")
+
+    def __init__(
+        self,
+        direction: Direction,
+        may: bool,
+        gen: Dict[Block, int],
+        kill: Dict[Block, int],
+        boundary: int=0,
+        top: int=0
+    ) -> None:
+        self.direction: Problem.Direction = direction
+        # Facts holding along any path meet by union, along all paths by
+        # intersection, starting from top
+        self.may: bool = may
+        self.gen: Dict[Block, int] = gen
+        self.kill: Dict[Block, int] = kill
+        # What holds on entry to the function, or on leaving it backwards
+        self.boundary: int = boundary
+        self.top: int = top
+
+
+# Facts at the start and the end of each block, in program order
+class Solution:
+
+    __slots__ = ("block_in", "block_out")
+
+    def __init__(
+        self
+    ) -> None:
+        self.block_in: Dict[Block, int] = dict()
+        self.block_out: Dict[Block, int] = dict()
+
+
+# Worklist solver, blocks are taken in reverse postorder (postorder for
+# backward problems) and only revisited when what flows into them changes
+def solve(
+    blocks: List[Block],
+    problem: Problem
+) -> Solution:
+    order: List[Block] = reverse_postorder(blocks)
+    reached: Set[Block] = set(order)
+    order.extend(block for block in blocks if block not in reached)
+
+    forward: bool = problem.direction == Problem.Direction.FORWARD
+    if not forward:
+        order.reverse()
+    rank: Dict[Block, int] = {block: idx for (idx, block) in enumerate(order)}
+
+    solution: Solution = Solution()
+    # Facts meeting into a block and leaving it along the direction of flow
+    before: Dict[Block, int] = solution.block_in if forward else solution.block_out
+    after: Dict[Block, int] = solution.block_out if forward else solution.block_in
+    initial: int = 0 if problem.may else problem.top
+    block: Block
+    for block in order:
+        before[block] = initial
+        after[block] = initial
+
+    def sources(
+        block: Block
+    ) -> List[Block]:
+        if forward:
+            return [edge.start for edge in block.in_edges]
+        return [edge.end for edge in block.out_edges]
+
+    def targets(
+        block: Block
+    ) -> List[Block]:
+        if forward:
+            return [edge.end for edge in block.out_edges]
+        return [edge.start for edge in block.in_edges]
+
+    worklist: List[int] = list(range(len(order)))
+    heapify(worklist)
+    pending: Set[int] = set(worklist)
+
+    while len(worklist) > 0:
+        idx: int = heappop(worklist)
+        pending.discard(idx)
+        block = order[idx]
+
+        values: List[int] = [after[source] for source in sources(block)]
+        at_boundary: bool = block is blocks[0] if forward else len(block.out_edges) == 0
+        if at_boundary:
+            values.append(problem.boundary)
+
+        meet: int = 0 if problem.may else problem.top
+        value: int
+        for value in values:
+            meet = (meet | value) if problem.may else (meet & value)
+        before[block] = meet
+
+        result: int = problem.gen[block] | (meet & ~problem.kill[block])
+        if result == after[block]:
+            continue
+        after[block] = result
+
+        target: Block
+        for target in targets(block):
+            if rank[target] not in pending:
+                pending.add(rank[target])
+                heappush(worklist, rank[target])
+
+    return solution
+
+
+# Definitions reaching the start of each block, numbered by position in the
+# returned list of the instructions that define a register
+def reaching_definitions(
+    blocks: List[Block]
+) -> Tuple[List[RTL], Solution]:
+    definitions: List[RTL] = []
+    defs_of: Dict[int, int] = dict()
+    block: Block
+    rtl: RTL
+
+    for block in blocks:
+        for rtl in block.rtls:
+            if rtl.def_mask == 0:
+                continue
+            bit: int = 1 << len(definitions)
+            definitions.append(rtl)
+            for reg in rtl.defs:
+                defs_of[reg.id] = defs_of.get(reg.id, 0) | bit
+
+    gen: Dict[Block, int] = dict()
+    kill: Dict[Block, int] = dict()
+    idx: int = 0
+    for block in blocks:
+        block_gen: int = 0
+        block_kill: int = 0
+        for rtl in block.rtls:
+            if rtl.def_mask == 0:
+                continue
+            # A later definition of the register hides the earlier ones
+            killed: int = 0
+            for reg in rtl.defs:
+                killed |= defs_of[reg.id]
+            block_gen = (block_gen & ~killed) | (1 << idx)
+            block_kill |= killed
+            idx += 1
+        gen[block] = block_gen
+        kill[block] = block_kill
+
+    return definitions, solve(
+        blocks,
+        Problem(Problem.Direction.FORWARD, True, gen, kill)
+    )
+
+
+# Structure of a computed value that does not touch memory, None otherwise
+def expression_key(
+    value: Value
+) -> Optional[Tuple[Any, ...]]:
+    if isinstance(value, Register):
+        return ("reg", value.id)
+    if isinstance(value, Const):
+        return ("const", value.value)
+    if isinstance(value, BinaryValue):
+        key1: Optional[Tuple[Any, ...]] = expression_key(value.value1)
+        key2: Optional[Tuple[Any, ...]] = expression_key(value.value2)
+        if key1 is None or key2 is None:
+            return None
+        op: Any = value.arith_op if isinstance(value, Arithmetic) else "compare"
+        return (op, value.result_type, key1, key2)
+    return None
+
+
+# Expressions computed on every path to the start of each block and not
+# overwritten since, numbered by position in the returned list of the
+# instructions that first compute each one
+def available_expressions(
+    blocks: List[Block]
+) -> Tuple[List[SetInsn], Solution]:
+    expressions: List[SetInsn] = []
+    numbers: Dict[Tuple[Any, ...], int] = dict()
+    uses_of: Dict[int, int] = dict()
+    block: Block
+    rtl: RTL
+
+    def number(
+        rtl: RTL
+    ) -> Optional[int]:
+        if not isinstance(rtl, SetInsn) or not isinstance(rtl.use_value, BinaryValue):
+            return None
+        key: Optional[Tuple[Any, ...]] = expression_key(rtl.use_value)
+        if key is None:
+            return None
+        if key not in numbers:
+            numbers[key] = len(expressions)
+            expressions.append(rtl)
+            for reg in rtl.uses:
+                uses_of[reg.id] = uses_of.get(reg.id, 0) | (1 << numbers[key])
+        return numbers[key]
+
+    computed: Dict[RTL, int] = dict()
+    for block in blocks:
+        for rtl in block.rtls:
+            expr: Optional[int] = number(rtl)
+            if expr is not None:
+                computed[rtl] = expr
+
+    gen: Dict[Block, int] = dict()
+    kill: Dict[Block, int] = dict()
+    for block in blocks:
+        block_gen: int = 0
+        block_kill: int = 0
+        for rtl in block.rtls:
+            if rtl in computed:
+                block_gen |= 1 << computed[rtl]
+            killed: int = 0
+            # A call may change any caller save register
+            written: int = rtl.def_mask | (CALLER_SAVE_MASK if isinstance(rtl, Call) else 0)
+            for id in RegisterTable.ids(written):
+                killed |= uses_of.get(id, 0)
+            block_gen &= ~killed
+            block_kill |= killed
+        gen[block] = block_gen
+        kill[block] = block_kill
+
+    return expressions, solve(
+        blocks,
+        Problem(
+            Problem.Direction.FORWARD,
+            False,
+            gen,
+            kill,
+            top=(1 << len(expressions)) - 1
+        )
+    )
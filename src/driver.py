@@ -1,6 +1,7 @@
-from os import getenv
+from os import getenv, path
+from concurrent.futures import ProcessPoolExecutor
 from sys import argv
-from typing import List, Tuple, Any, Optional, Dict
+from typing import List, Tuple, Any, Optional, Dict, Iterator, cast
 
 import sexp as s
 import rtl as r
@@ -8,75 +9,185 @@ import graph as g
 import liveness as l
 import scheduling as i
 import rtl.value as v
+import cache as c
+import feedback as p
+import layout as b
+import report as rp
 
 class IllegalArgumentError(Exception):
     pass
 
 def parse_args(
     args: List[str]
-) -> Tuple[str,str]:
+) -> Tuple[str,str,Optional[str],Optional[str]]:
+    usage: str = "Usage: {} [--profile profile_file] [--report report_file] in_file out_file".format(args[0])
+    options: Dict[str,Optional[str]] = {"--profile": None, "--report": None}
+    rest: List[str] = args[1 : ]
+
+    while len(rest) > 0 and rest[0] in options:
+        if len(rest) < 2:
+            raise IllegalArgumentError(usage)
+        options[rest[0]] = rest[1]
+        rest = rest[2 : ]
+
     try:
-        _, in_file, out_file = args
+        in_file, out_file = rest
     except ValueError:
-        raise IllegalArgumentError("Usage: {} in_file out_file".format(args[0]))
-
-    return in_file, out_file
+        raise IllegalArgumentError(usage)
 
+    return in_file, out_file, options["--profile"], options["--report"]
 
-def main(
-) -> None:
-    rtls: List[r.RTL] = []
-    spilled: List[r.Register] = []
 
+# Builds the RTL of every function in the dump, in source order
+def read_functions(
     in_file: str
-    out_file: str
-    in_file, out_file = parse_args(argv)
+) -> Iterator[c.Function]:
+    func_name: str
+    rtl_sexps: Iterator[List[Any]]
+    for func_name, rtl_sexps in s.read_sexp(in_file, codes=r.RTL.INSN_CODES):
+        rtls: List[r.RTL] = []
+        registers: v.RegisterTable = v.RegisterTable()
+
+        # The forms are parsed lazily as each one is consumed
+        for rtl_sexp in rtl_sexps:
+            rtls += r.RTL.factory(rtl_sexp, registers)
+
+        if len(rtls) > 0:
+            yield func_name, registers, rtls
+
+
+# Runs the backend on one function and returns its assembly, along with
+# what the passes decided when a report is asked for
+def compile_function(
+    function: c.Function,
+    counts: Optional[p.Counts]=None,
+    report: bool=False
+) -> Tuple[str,Optional[rp.FunctionReport]]:
+    rtls: List[r.RTL]
+    registers: v.RegisterTable
+    spilled: List[r.Register] = []
 
-    rtl_sexps: List[List[Any]]
-    r.func_name, rtl_sexps = s.read_sexp(in_file)
+    # Labels are named after the function being compiled by this process
+    r.func_name, registers, rtls = function
+    function_report: Optional[rp.FunctionReport] = (
+        rp.FunctionReport(r.func_name) if report else None
+    )
 
-    for rtl_sexp in rtl_sexps:
-        rtls += r.RTL.factory(rtl_sexp)
+    # Measured branch counts take over from the static guesses
+    if counts is not None:
+        p.apply_profile(rtls, counts)
 
-    vertices: List[g.Vertex] = g.generate_cfg(rtls)
-    g.compute_expect(vertices)
+    blocks: List[g.Block] = g.generate_cfg(rtls)
+    loops: List[g.Loop] = g.compute_expect(blocks)
     if not getenv("NO_SCHEDULE"):
-        l.compute_liveness(vertices)
-        rtls = i.trace_schedule(vertices)
-        vertices = g.generate_cfg(rtls)
-        g.compute_expect(vertices)
+        l.compute_liveness(blocks)
+        trace: List[r.RTL]
+        rtls, trace = i.trace_schedule(blocks, registers)
+        if function_report is not None:
+            function_report.add_trace(trace)
+        blocks = g.generate_cfg(rtls)
+        loops = g.compute_expect(blocks)
 
     # if not getenv("NO_SCHEDULE"):
-    #     i.bb_instruction_schedule(vertices, None)
+    #     i.bb_instruction_schedule(blocks, None)
 
     colorable: bool = False
     colors: Dict[r.Register,int]
-    matrix: l.Matrix[r.Register]
+    l.compute_liveness(blocks)
+    graph: l.InterferenceGraph = l.interference_graph(blocks, registers)
     while not colorable:
-
-        l.compute_liveness(vertices)
-        matrix = l.interference_matrix(vertices)
-        
         colorable = True
         try:
-            colors = l.color_graph(matrix)
+            colors = l.color_graph(graph)
         except l.UncolorableError:
             colorable = False
         
         if not colorable:
-            spill_reg: r.VirtualRegister = l.spill_candidate(vertices)
+            spill_reg: r.VirtualRegister
+            spill_cost: float
+            spill_reg, spill_cost = l.spill_candidate(blocks)
+            if function_report is not None:
+                function_report.add_spill(spill_reg, spill_cost)
             spilled.append(spill_reg)
-            l.spill_register(vertices, spill_reg)
+            spill: l.Spill = l.spill_register(blocks, spill_reg, registers)
+
+            # Only the spilled register's live ranges changed
+            l.update_liveness(blocks, spill)
+            l.update_interference(graph, spill)
 
     register_allocation: v.RegMap = l.color_to_register(colors)
     # if not getenv("NO_SCHEDULE"):
-    #     i.bb_instruction_schedule(vertices, register_allocation)
+    #     i.bb_instruction_schedule(blocks, register_allocation)
+
+    # Layout rewrites branches, so the CFG is described before it runs
+    if function_report is not None:
+        function_report.add_blocks(blocks, loops)
+
+    if not getenv("NO_LAYOUT"):
+        rtls = b.layout_blocks(blocks)
+    else:
+        rtls = list(g.instructions(blocks))
+
+    if function_report is not None:
+        function_report.add_schedule(rtls)
+    return r.generate_assembly(rtls, register_allocation, spilled), function_report
+
 
-    rtls = [vertex.rtl for vertex in vertices]
-    asm: str = r.generate_assembly(rtls, register_allocation, spilled)
+def main(
+) -> None:
+    in_file: str
+    out_file: str
+    profile_file: Optional[str]
+    report_file: Optional[str]
+    in_file, out_file, profile_file, report_file = parse_args(argv)
+
+    profile: p.Profile = dict()
+    if profile_file is not None:
+        profile = p.read_profile(profile_file)
+
+    functions: Optional[List[c.Function]] = None
+    key: str = ""
+    if not getenv("NO_CACHE"):
+        key = c.cache_key(in_file)
+        functions = c.load(key)
+
+    # Parse on a cache miss, before any pass mutates the RTL
+    if functions is None:
+        functions = list(read_functions(in_file))
+        if not getenv("NO_CACHE"):
+            c.store(key, functions)
+
+    counts: List[Optional[p.Counts]] = [
+        profile.get(function[0]) for function in functions
+    ]
+
+    reports: List[bool] = [report_file is not None] * len(functions)
+    results: List[Tuple[str,Optional[rp.FunctionReport]]]
+    if len(functions) > 1:
+        # Functions are independent, compile them on every core
+        with ProcessPoolExecutor() as pool:
+            results = list(pool.map(compile_function, functions, counts, reports))
+    else:
+        results = [
+            compile_function(function, function_counts, report)
+            for (function, function_counts, report) in zip(functions, counts, reports)
+        ]
 
     with open(out_file, "w") as f:
-        f.write(asm)
+        f.write("".join(asm for (asm, _) in results))
+
+    # The JSON report goes where asked and its DOT rendering beside it
+    if report_file is not None:
+        function_reports: List[rp.FunctionReport] = [
+            cast(rp.FunctionReport, function_report) for (_, function_report) in results
+        ]
+        with open(report_file, "w") as f:
+            f.write(rp.to_json(function_reports))
+        dot_file: str = path.splitext(report_file)[0] + ".dot"
+        if dot_file == report_file:
+            dot_file += ".dot"
+        with open(dot_file, "w") as f:
+            f.write(rp.to_dot(function_reports))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,62 @@
+from typing import Dict, List, Tuple
+
+from rtl import *
+
+# Measured (taken, not taken) counts of each conditional jump by insn uid
+Counts = Dict[int, Tuple[int, int]]
+# The counts of every function in a profile by function name
+Profile = Dict[str, Counts]
+
+class ProfileError(ValueError):
+    pass
+
+# Reads a profile, one "function uid taken not_taken" entry per line,
+# blank lines and anything after a "#" are ignored
+def read_profile(
+    file_name: str
+) -> Profile:
+    profile: Profile = dict()
+    line_num: int
+    line: str
+
+    with open(file_name, "r") as f:
+        for line_num, line in enumerate(f, 1):
+            fields: List[str] = line.split("#", 1)[0].split()
+            if len(fields) == 0:
+                continue
+
+            try:
+                func_name, uid, taken, not_taken = fields
+                counts: Tuple[int, int] = (int(taken), int(not_taken))
+                insn_uid: int = int(uid)
+            except ValueError:
+                raise ProfileError(
+                    "{}:{}: expected function uid taken not_taken".format(file_name, line_num)
+                )
+
+            if counts[0] < 0 or counts[1] < 0:
+                raise ProfileError(
+                    "{}:{}: counts must not be negative".format(file_name, line_num)
+                )
+
+            # Repeated entries, say from several runs, are summed
+            prev: Tuple[int, int] = profile.setdefault(func_name, dict()).get(insn_uid, (0, 0))
+            profile[func_name][insn_uid] = (prev[0] + counts[0], prev[1] + counts[1])
+
+    return profile
+
+
+# Replaces the static probability of every jump that was measured
+def apply_profile(
+    rtls: List[RTL],
+    counts: Counts
+) -> None:
+    rtl: RTL
+    for rtl in rtls:
+        if isinstance(rtl, ConditionalJump) and rtl.this_insn in counts:
+            taken, not_taken = counts[rtl.this_insn]
+            # A jump that never ran tells us nothing, keep the static guess
+            if taken + not_taken > 0:
+                rtl.prob = taken / (taken + not_taken)
+                rtl.guessed = False
+                rtl.measured = True
@@ -1,101 +1,150 @@
-
-from typing import List
+from typing import List, Iterable, Mapping, Optional, Tuple
+from types import MappingProxyType
 from enum import Enum
 from queue import Queue
 
 from rtl import *
+from order import OrderedList
+
+# Shared placeholder for the expects of a block that has none yet
+EMPTY_EXPECTS: Mapping[Any, float] = MappingProxyType(dict())
+
+# Control flow structures, a straight-line run of instructions per block
+class Block:
 
-# Control flow structures
-class Vertex:
+    __slots__ = (
+        "in_edges", "out_edges", "rtls", "visited", "innermost",
+        "uses", "defs", "live_in", "live_out", "idom", "dom_pre", "dom_post",
+        "expect", "expects"
+    )
 
     def __init__(
         self, 
-        rtl: RTL
+        rtls: Iterable[RTL]
     ) -> None:
         self.in_edges: List[Edge] = []
         self.out_edges: List[Edge] = []
 
-        self.rtl: RTL = rtl
+        self.rtls: OrderedList[RTL] = OrderedList(rtls)
 
         self.visited: bool = False
-        self.loop: int = 0
+        self.innermost: Optional[Loop] = None
 
-        self.live_in: Set[Register] = set()
-        self.live_out: Set[Register] = set()
+        # Bitsets over the ids of the function's RegisterTable
+        self.uses: int = 0
+        self.defs: int = 0
+        self.live_in: int = 0
+        self.live_out: int = 0
 
-        self.dom: Set['Vertex'] = set()
+        # Dominator tree, numbered so dominates() is a range check
+        self.idom: Optional[Block] = None
+        self.dom_pre: int = -1
+        self.dom_post: int = -1
 
         self.expect: float = 0.0
-        self.expects: Dict[Vertex, float] = dict()
+        self.expects: Mapping[Block, float] = EMPTY_EXPECTS
 
-    def init_liveness(
+    @property
+    def first(
         self
-    ) -> None:
-        self.live_out.clear()
-        self.live_in.clear()
+    ) -> RTL:
+        return self.rtls.first
 
-    def add_dom(
-        self,
-        vertex: 'Vertex'
-    ) -> None:
-        self.dom.add(vertex)
+    @property
+    def last(
+        self
+    ) -> RTL:
+        return self.rtls.last
+
+    # Loop nesting depth
+    @property
+    def loop(
+        self
+    ) -> int:
+        return 0 if self.innermost is None else self.innermost.depth
 
-    def update_dom(
+    # Runs per entry into the outermost loop around the block, branches aside
+    @property
+    def loop_weight(
+        self
+    ) -> float:
+        return 1.0 if self.innermost is None else self.innermost.weight
+
+    @property
+    def is_header(
         self
     ) -> bool:
-        tmp: Set['Vertex'] = set()
-        edge: Edge
-        change: bool
+        return self.innermost is not None and self.innermost.header is self
 
-        tmp = tmp.union(self.in_edges[0].start.dom)
-        for edge in self.in_edges[1 : ]:
-            tmp.intersection_update(edge.start.dom)
-        tmp.add(self)
+    @property
+    def basic_block(
+        self
+    ) -> int:
+        return self.rtls.first.basic_block
 
-        change = False
-        if len(tmp) != len(self.dom):
-            change = True
-            self.dom = tmp
+    # Upward exposed uses and the defs of the whole block
+    def summarize_liveness(
+        self
+    ) -> None:
+        uses: int = 0
+        defs: int = 0
+
+        for rtl in reversed(self.rtls):
+            uses = rtl.use_mask | (uses & ~rtl.def_mask)
+            defs |= rtl.def_mask
 
-        return change
+        self.uses = uses
+        self.defs = defs
 
-    def compute_live_out(
+    def init_liveness(
         self
     ) -> None:
-        self.live_out = set()
+        self.summarize_liveness()
+        self.live_out = 0
+        self.live_in = 0
 
-        for edge in self.out_edges:
-            self.live_out = self.live_out.union(edge.end.live_in)
+    def add_expect(
+        self,
+        block: 'Block',
+        expect: float
+    ) -> None:
+        if self.expects is EMPTY_EXPECTS:
+            self.expects = dict()
+        cast(Dict[Block, float], self.expects)[block] = expect
 
-    def compute_live_in(
+    # Live in of each instruction, derived from the live out of the block
+    def instruction_live_in(
         self
-    ) -> bool:
-        temp = self.rtl.uses.union(self.live_out.difference(self.rtl.defs))
-        changed: bool = False
+    ) -> List[int]:
+        live_in: List[int] = []
+        live: int = self.live_out
 
-        if temp != self.live_in:
-            self.live_in = temp
-            changed = True
+        for rtl in reversed(self.rtls):
+            live = rtl.use_mask | (live & ~rtl.def_mask)
+            live_in.append(live)
 
-        return changed
+        live_in.reverse()
+        return live_in
 
 
 class Edge:
 
+    __slots__ = ("start", "end", "edge_type", "src_bb", "dest_bb", "visited")
+
     class EdgeType(Enum):
         SEQUENTIAL: int = 2
         JUMP: int = 3
 
     def __init__(
         self, 
-        start: Vertex, 
-        end: Vertex, 
+        start: Block, 
+        end: Block, 
         edge_type: EdgeType, 
         src_bb: int, 
         dest_bb: int
     ) -> None:
-        self.start: Vertex = start
-        self.end: Vertex = end
+        self.start: Block = start
+        self.end: Block = end
 
         self.edge_type: Edge.EdgeType = edge_type
 
@@ -106,84 +155,242 @@ class Edge:
 
     @staticmethod
     def link(
-        start: Vertex, 
-        end: Vertex, 
+        start: Block, 
+        end: Block, 
         edge_type: EdgeType
     ):
         edge = Edge(
             start,
             end,
             edge_type,
-            start.rtl.basic_block,
-            end.rtl.basic_block
+            start.basic_block,
+            end.basic_block
         )
         start.out_edges.append(edge)
         end.in_edges.append(edge)
 
 
-# Generates an instruction local CFG
+# A natural loop, every back edge into the header is merged into one loop
+class Loop:
+
+    __slots__ = (
+        "header", "body", "exits", "depth", "parent", "children", "preheader",
+        "trip_count", "iterations"
+    )
+
+    def __init__(
+        self,
+        header: Block,
+        body: Set[Block],
+        parent: Optional['Loop']
+    ) -> None:
+        self.header: Block = header
+        self.body: Set[Block] = body
+        self.exits: List[Edge] = []
+
+        self.parent: Optional[Loop] = parent
+        self.children: List[Loop] = []
+        self.depth: int = 1 if parent is None else parent.depth + 1
+        if parent is not None:
+            parent.children.append(self)
+
+        self.preheader: Optional[Block] = None
+
+        # Exact runs of the header per entry when the induction variable
+        # gives it away, and the estimate frequencies use, which follows the
+        # trip count unless the exit test was measured by a profile
+        self.trip_count: Optional[int] = None
+        self.iterations: float = 1.0
+
+    # Runs of the header per entry into the outermost loop around it
+    @property
+    def weight(
+        self
+    ) -> float:
+        return self.iterations * (1.0 if self.parent is None else self.parent.weight)
+
+
+# Whether control can leave an instruction other than by falling through
+def ends_block(
+    rtl: RTL
+) -> bool:
+    return (
+        isinstance(rtl, Jump)
+        or (isinstance(rtl, Call) and cast(Call, rtl).is_exit_func())
+    )
+
+
+# Generates a basic block CFG
 def generate_cfg(
     rtls: List[RTL]
-) -> List[Vertex]:
-    vertex: Vertex
-    next_vertex: Vertex
-    vertices: List[Vertex] = [Vertex(rtl) for rtl in rtls]
-    insn_reference: Dict[int,Vertex] = {vertex.rtl.this_insn: vertex for vertex in vertices}
+) -> List[Block]:
+    block: Block
+    next_block: Block
+    blocks: List[Block] = []
+    targets: Set[int] = set(
+        cast(Jump, rtl).jump_loc for rtl in rtls if isinstance(rtl, Jump)
+    )
+
+    # Split at jump targets, after branches and wherever the basic block changes
+    for idx, rtl in enumerate(rtls):
+        if (
+            idx == 0
+            or rtl.this_insn in targets
+            or rtl.basic_block != rtls[idx - 1].basic_block
+            or ends_block(rtls[idx - 1])
+        ):
+            blocks.append(Block([]))
+        blocks[-1].rtls.append(rtl)
+
+    insn_reference: Dict[int,Block] = {block.first.this_insn: block for block in blocks}
+
+    for idx in range(len(blocks) - 1):
+        block = blocks[idx]
+
+        if isinstance(block.last, Jump):
+            jump_rtl: Jump = cast(Jump, block.last)
+            next_block = insn_reference[jump_rtl.jump_loc]
+            Edge.link(block, next_block, Edge.EdgeType.JUMP)
+
+            if isinstance(block.last, ConditionalJump):
+                next_block = blocks[idx + 1]
+                Edge.link(block, next_block, Edge.EdgeType.SEQUENTIAL)
+
+        elif isinstance(block.last, Call) and cast(Call, block.last).is_exit_func():
+            pass
+
+        else:
+            next_block = blocks[idx + 1]
+            Edge.link(block, next_block, Edge.EdgeType.SEQUENTIAL)
 
-    for idx in range(len(vertices) - 1):
-        vertex = vertices[idx]
+    return blocks
 
-        if isinstance(vertex.rtl, Jump):
-            jump_rtl: Jump = cast(Jump, vertex.rtl)
-            next_vertex = insn_reference[jump_rtl.jump_loc]
-            Edge.link(vertex, next_vertex, Edge.EdgeType.JUMP)
 
-            if isinstance(vertex.rtl, ConditionalJump):
-                next_vertex = vertices[idx + 1]
-                Edge.link(vertex, next_vertex, Edge.EdgeType.SEQUENTIAL)
+# The instructions of every block in layout order
+def instructions(
+    blocks: List[Block]
+) -> OrderedList[RTL]:
+    return OrderedList(rtl for block in blocks for rtl in block.rtls)
 
-        elif isinstance(vertex.rtl, Call) and cast(Call, vertex.rtl).is_exit_func():
-            pass
 
+# Blocks reachable from the entry in reverse postorder
+def reverse_postorder(
+    blocks: List[Block]
+) -> List[Block]:
+    order: List[Block] = []
+    seen: Set[Block] = {blocks[0]}
+    stack: List[Tuple[Block, int]] = [(blocks[0], 0)]
+    block: Block
+    idx: int
+
+    while len(stack) > 0:
+        block, idx = stack.pop()
+        if idx < len(block.out_edges):
+            stack.append((block, idx + 1))
+            next_block: Block = block.out_edges[idx].end
+            if next_block not in seen:
+                seen.add(next_block)
+                stack.append((next_block, 0))
         else:
-            next_vertex = vertices[idx + 1]
-            Edge.link(vertex, next_vertex, Edge.EdgeType.SEQUENTIAL)
+            order.append(block)
 
-    return vertices
+    order.reverse()
+    return order
 
 
+# Immediate dominators (Cooper, Harvey and Kennedy) numbered in tree order
 def dominance(
-    vertices: List[Vertex]
+    blocks: List[Block]
 ) -> None:
-    vertex: Vertex
+    block: Block
+    edge: Edge
 
-    vertices[0].add_dom(vertices[0])
-    for vertex in vertices[1 : ]:
-        for dom_vertex in vertices:
-            vertex.add_dom(dom_vertex)
+    for block in blocks:
+        block.idom = None
+        block.dom_pre = -1
+        block.dom_post = -1
+
+    order: List[Block] = reverse_postorder(blocks)
+    rpo: Dict[Block,int] = {block: idx for (idx, block) in enumerate(order)}
+    entry: Block = order[0]
+    idoms: Dict[Block,Block] = {entry: entry}
+
+    def intersect(
+        finger1: Block,
+        finger2: Block
+    ) -> Block:
+        while finger1 is not finger2:
+            while rpo[finger1] > rpo[finger2]:
+                finger1 = idoms[finger1]
+            while rpo[finger2] > rpo[finger1]:
+                finger2 = idoms[finger2]
+        return finger1
 
     change: bool = True
     while change:
         change = False
 
-        for vertex in vertices[1 : ]:
-            if vertex.update_dom():
+        for block in order[1 : ]:
+            new_idom: Optional[Block] = None
+            for edge in block.in_edges:
+                if edge.start not in idoms:
+                    continue
+                if new_idom is None:
+                    new_idom = edge.start
+                else:
+                    new_idom = intersect(edge.start, new_idom)
+
+            if idoms.get(block) is not new_idom:
+                idoms[block] = cast(Block, new_idom)
                 change = True
 
+    children: Dict[Block,List[Block]] = {block: [] for block in order}
+    for block in order[1 : ]:
+        block.idom = idoms[block]
+        children[idoms[block]].append(block)
 
-# Backedge m to n
+    # Pre and post numbers over the dominator tree
+    counter: int = 0
+    stack: List[Tuple[Block, bool]] = [(entry, False)]
+    done: bool
+    while len(stack) > 0:
+        block, done = stack.pop()
+        if done:
+            block.dom_post = counter
+        else:
+            block.dom_pre = counter
+            stack.append((block, True))
+            stack.extend((child, False) for child in reversed(children[block]))
+        counter += 1
+
+
+# Whether a dominates b, unreachable blocks dominate nothing
+def dominates(
+    a: Block,
+    b: Block
+) -> bool:
+    return (
+        a.dom_pre != -1
+        and b.dom_pre != -1
+        and a.dom_pre <= b.dom_pre
+        and b.dom_post <= a.dom_post
+    )
+
+
+# Blocks reaching a latch without passing through the header
 def identify_loop(
-    vertices: List[Vertex],
-    m: Vertex,
-    n: Vertex
-) -> Set[Vertex]:
-    loop: Set[Vertex] = {m, n}
-    stack: List[Vertex] = []
-    p: Vertex
-    q: Vertex
-
-    if m is not n:
-        stack.append(m)
+    header: Block,
+    latches: List[Block]
+) -> Set[Block]:
+    loop: Set[Block] = {header}
+    stack: List[Block] = []
+    p: Block
+    q: Block
+
+    for p in latches:
+        if p not in loop:
+            loop.add(p)
+            stack.append(p)
 
     while len(stack) > 0:
         p = stack.pop()
@@ -198,99 +405,497 @@ def identify_loop(
     return loop
 
 
-def identify_backedge(
-    vertices: List[Vertex]
-) -> Set[Vertex]:
-    vertex: Vertex
-    loop: Set[Vertex]
+# Loop nesting forest from the dominator tree, outer loops first
+def identify_loops(
+    blocks: List[Block]
+) -> List[Loop]:
+    block: Block
     edge: Edge
-    loop_header: Vertex
-    loop_headers: Set[Vertex] = set()
-    idx: int
-    max_bb: int
-    new_vertex: Vertex
-
-    for vertex in vertices:
-        for edge in vertex.out_edges:
-            if edge.end in vertex.dom:
-                loop_header = edge.end
-                loop = identify_loop(vertices, vertex, loop_header)
-                loop_headers.add(loop_header)
+    header: Block
+    loop: Loop
+    latches: Dict[Block,List[Block]] = dict()
+    loops: List[Loop] = []
+
+    for block in blocks:
+        block.innermost = None
+        for edge in block.out_edges:
+            if dominates(edge.end, block):
+                latches.setdefault(edge.end, []).append(block)
+
+    # A header is dominated by the headers of every loop around it
+    for header in sorted(latches, key=lambda block: block.dom_pre):
+        loop = Loop(header, identify_loop(header, latches[header]), header.innermost)
+        for block in loop.body:
+            block.innermost = loop
+        loops.append(loop)
+
+    return loops
+
+
+# Gives every loop a preheader, reusing one left by an earlier pass
+def insert_preheaders(
+    blocks: List[Block],
+    loops: List[Loop]
+) -> None:
+    loop: Loop
+    edge: Edge
+    new_block: Block
+    preheaders: Dict[Block,Block] = dict()
+    max_bb: int = max(map(lambda block: block.basic_block, blocks))
 
-                for v in loop:
-                    v.loop += 1
-
-    max_bb = max(map(lambda vertex: vertex.rtl.basic_block, vertices))
-    for loop_header in loop_headers:
-        max_bb += 1
-        new_vertex = Vertex(LoopPreheader(-1, max_bb))
+    for loop in loops:
+        loop_header: Block = loop.header
 
         preheader_in_edges: List[Edge] = []
         loop_header_in_edges: List[Edge] = []
+        # Only entries that fall through can be routed into the preheader
         for edge in loop_header.in_edges:
-            if edge.edge_type == Edge.EdgeType.SEQUENTIAL:
-                edge.end = new_vertex
+            if edge.edge_type not in (Edge.EdgeType.SEQUENTIAL, Edge.EdgeType.JUMP):
+                raise NotImplementedError
+            if (
+                edge.edge_type == Edge.EdgeType.SEQUENTIAL
+                and edge.start not in loop.body
+            ):
                 preheader_in_edges.append(edge)
-            elif edge.edge_type == Edge.EdgeType.JUMP:
-                loop_header_in_edges.append(edge)
             else:
-                raise NotImplementedError
-        new_vertex.in_edges = preheader_in_edges
+                loop_header_in_edges.append(edge)
+
+        if len(preheader_in_edges) == 0:
+            continue
+
+        if (
+            len(preheader_in_edges) == 1
+            and isinstance(preheader_in_edges[0].start.first, LoopPreheader)
+            and len(preheader_in_edges[0].start.out_edges) == 1
+        ):
+            loop.preheader = preheader_in_edges[0].start
+            continue
+
+        max_bb += 1
+        new_block = Block([LoopPreheader(-1, max_bb)])
+        for edge in preheader_in_edges:
+            edge.end = new_block
+        new_block.in_edges = preheader_in_edges
         loop_header.in_edges = loop_header_in_edges
-        Edge.link(new_vertex, loop_header, Edge.EdgeType.SEQUENTIAL)
+        Edge.link(new_block, loop_header, Edge.EdgeType.SEQUENTIAL)
+
+        new_block.innermost = loop.parent
+        ancestor: Optional[Loop] = loop.parent
+        while ancestor is not None:
+            ancestor.body.add(new_block)
+            ancestor = ancestor.parent
+
+        loop.preheader = new_block
+        preheaders[loop_header] = new_block
+
+    # Rebuild the layout once rather than inserting block by block
+    if len(preheaders) > 0:
+        blocks[:] = [
+            placed
+            for block in blocks
+            for placed in (
+                (preheaders[block], block) if block in preheaders else (block,)
+            )
+        ]
+
+    # An exit leaves every loop from the innermost one out to its target
+    for block in blocks:
+        for edge in block.out_edges:
+            ancestor = block.innermost
+            while ancestor is not None and edge.end not in ancestor.body:
+                ancestor.exits.append(edge)
+                ancestor = ancestor.parent
+
+
+# Share of a block's executions that leave along the edge
+def edge_probability(
+    edge: Edge
+) -> float:
+    if isinstance(edge.start.last, ConditionalJump):
+        if edge.edge_type == Edge.EdgeType.JUMP:
+            return edge.start.last.prob
+        return 1 - edge.start.last.prob
+    return 1.0
+
+
+# The comparison that holds when the operands trade places
+SWAPPED_COMPS: Dict[str, str] = {
+    "eq": "eq", "ne": "ne",
+    "lt": "gt", "gt": "lt",
+    "le": "ge", "ge": "le",
+    "ltu": "gtu", "gtu": "ltu",
+    "leu": "geu", "geu": "leu"
+}
+
+# How often each static heuristic picks the way a branch goes (Ball and
+# Larus, with the hit rates measured by Wu and Larus)
+LOOP_BRANCH_HIT: float = 0.88
+LOOP_EXIT_HIT: float = 0.80
+OPCODE_HIT: float = 0.84
+CALL_HIT: float = 0.78
+NORETURN_HIT: float = 0.999
+
+# Combines two independent guesses at the same probability (Dempster-Shafer)
+def combine_guesses(
+    prob1: float,
+    prob2: float
+) -> float:
+    agree: float = prob1 * prob2
+    return agree / (agree + (1 - prob1) * (1 - prob2))
+
+
+# Probability the jump of a block is taken from the heuristics that apply,
+# an even guess when none do
+def guess_probability(
+    block: Block
+) -> float:
+    jump: ConditionalJump = cast(ConditionalJump, block.last)
+    taken: Optional[Block] = None
+    fall: Optional[Block] = None
+    edge: Edge
+    for edge in block.out_edges:
+        if edge.edge_type == Edge.EdgeType.JUMP:
+            taken = edge.end
+        else:
+            fall = edge.end
+    if taken is None or fall is None or taken is fall:
+        return 0.5
+
+    # Each guess is the probability of taking the jump
+    guesses: List[float] = []
+    loop: Optional[Loop] = block.innermost
+
+    if dominates(taken, block):
+        guesses.append(LOOP_BRANCH_HIT)
+    elif dominates(fall, block):
+        guesses.append(1 - LOOP_BRANCH_HIT)
+    elif loop is not None and (taken in loop.body) != (fall in loop.body):
+        guesses.append(LOOP_EXIT_HIT if taken in loop.body else 1 - LOOP_EXIT_HIT)
+
+    # Values are rarely negative and rarely equal to a given constant
+    rtl: RTL
+    for rtl in reversed(block.rtls):
+        if isinstance(rtl, SetInsn) and isinstance(rtl.def_value, ConditionCodes):
+            if isinstance(rtl.use_value, Compare):
+                compare: Compare = rtl.use_value
+                comp: str = jump.comp
+                bound: Value = compare.value2
+                if isinstance(compare.value1, Const):
+                    comp = SWAPPED_COMPS.get(comp, comp)
+                    bound = compare.value1
+                if isinstance(bound, Const):
+                    if comp == "eq" or (bound.value == 0 and comp in ("lt", "le")):
+                        guesses.append(1 - OPCODE_HIT)
+                    elif comp == "ne" or (bound.value == 0 and comp in ("gt", "ge")):
+                        guesses.append(OPCODE_HIT)
+            break
+
+    # Paths into exit() are almost never taken, other calls are avoided
+    def calls(
+        target: Block
+    ) -> Tuple[bool, bool]:
+        found: List[Call] = [rtl for rtl in target.rtls if isinstance(rtl, Call)]
+        return (
+            any(call.is_exit_func() for call in found),
+            len(found) > 0
+        )
 
-        new_vertex.loop = loop_header.loop - 1
+    (taken_exits, taken_calls) = calls(taken)
+    (fall_exits, fall_calls) = calls(fall)
+    if taken_exits != fall_exits:
+        guesses.append(1 - NORETURN_HIT if taken_exits else NORETURN_HIT)
+    elif taken_calls != fall_calls:
+        guesses.append(1 - CALL_HIT if taken_calls else CALL_HIT)
 
-        idx = vertices.index(loop_header)
-        vertices.insert(idx, new_vertex)
-    
-    return loop_headers
+    prob: float = 0.5
+    guess: float
+    for guess in guesses:
+        prob = combine_guesses(prob, guess)
+    return prob
+
+
+# Fills in the jumps the dump gave no probability for
+def guess_probabilities(
+    blocks: List[Block]
+) -> None:
+    block: Block
+    for block in blocks:
+        if isinstance(block.last, ConditionalJump) and block.last.guessed:
+            block.last.prob = guess_probability(block)
+
+
+# One pass in topological order, back edges are left out and a loop header
+# scales what enters it by the iterations of its loop
+def propagate_expect(
+    order: List[Block],
+    entry_expect: float
+) -> Dict[Block, float]:
+    expects: Dict[Block, float] = {order[0]: entry_expect}
+    block: Block
+    edge: Edge
+
+    for block in order[1 : ]:
+        new_expect: float = 0.0
+        for edge in block.in_edges:
+            if edge.start in expects:
+                new_expect += expects[edge.start] * edge_probability(edge)
+        if block.is_header:
+            new_expect *= cast(Loop, block.innermost).iterations
+        expects[block] = new_expect
+
+    return expects
+
+
+# The single update of reg in the loop, which must add or subtract a
+# constant, and the amount it steps by
+def induction_step(
+    loop: Loop,
+    reg: VirtualRegister
+) -> Optional[Tuple[SetInsn, Block, int]]:
+    found: Optional[Tuple[SetInsn, Block, int]] = None
+    block: Block
+    rtl: RTL
+
+    for block in loop.body:
+        for rtl in block.rtls:
+            if reg not in rtl.defs:
+                continue
+            if found is not None or not isinstance(rtl, SetInsn):
+                return None
+
+            value: Value = rtl.use_value
+            if (
+                not isinstance(value, Arithmetic)
+                or value.arith_op not in (Arithmetic.ArithmeticOp.PLUS, Arithmetic.ArithmeticOp.MINUS)
+            ):
+                return None
+
+            if value.value1 == reg and isinstance(value.value2, Const):
+                step: int = value.value2.value
+            elif (
+                value.arith_op == Arithmetic.ArithmeticOp.PLUS
+                and value.value2 == reg
+                and isinstance(value.value1, Const)
+            ):
+                step = value.value1.value
+            else:
+                return None
+
+            if value.arith_op == Arithmetic.ArithmeticOp.MINUS:
+                step = -step
+            found = (rtl, block, step)
+
+    if found is None or found[2] == 0:
+        return None
+    return found
+
+
+# The constant reg holds on entry, found by walking back from a block
+# outside the loop while there is only one way in
+def initial_value(
+    block: Block,
+    reg: VirtualRegister
+) -> Optional[int]:
+    seen: Set[Block] = set()
+    rtl: RTL
+
+    while block not in seen:
+        seen.add(block)
+        for rtl in reversed(block.rtls):
+            if reg not in rtl.defs:
+                continue
+            if isinstance(rtl, SetInsn) and isinstance(rtl.use_value, Const):
+                return rtl.use_value.value
+            return None
+
+        if len(block.in_edges) != 1:
+            return None
+        block = block.in_edges[0].start
+
+    return None
+
+
+# Tests run until "value comp bound" first fails when the value starts at
+# first and moves by step after each test, None if it never fails
+def count_tests(
+    first: int,
+    step: int,
+    comp: str,
+    bound: int
+) -> Optional[int]:
+    if comp == "ne":
+        if (bound - first) % step != 0 or (bound - first) // step < 0:
+            return None
+        return (bound - first) // step + 1
+    if comp == "eq":
+        return 2 if first == bound else 1
+
+    if comp == "le":
+        comp, bound = "lt", bound + 1
+    elif comp == "ge":
+        comp, bound = "gt", bound - 1
+
+    if comp == "lt":
+        if first >= bound:
+            return 1
+        if step < 0:
+            return None
+        return -((first - bound) // step) + 1
+    if comp == "gt":
+        if first <= bound:
+            return 1
+        if step > 0:
+            return None
+        return -((bound - first) // -step) + 1
+
+    return None
+
+
+# Runs of the header per entry for a loop with one exit, tested against a
+# constant bound by a register stepped by a constant from a constant start
+def estimate_trip_count(
+    loop: Loop
+) -> Optional[int]:
+    if len(loop.exits) != 1:
+        return None
+
+    exit_edge: Edge = loop.exits[0]
+    test_block: Block = exit_edge.start
+    jump: RTL = test_block.last
+    if not isinstance(jump, ConditionalJump) or jump.comp not in SWAPPED_COMPS:
+        return None
+
+    compare: Optional[SetInsn] = None
+    rtl: RTL
+    for rtl in reversed(test_block.rtls):
+        if isinstance(rtl, SetInsn) and isinstance(rtl.def_value, ConditionCodes):
+            compare = rtl
+            break
+    if compare is None or not isinstance(compare.use_value, Compare):
+        return None
+
+    # Normalize to "reg comp bound" holding while the loop goes around
+    comp: str = jump.comp
+    if exit_edge.edge_type == Edge.EdgeType.JUMP:
+        comp = ConditionalJump.INVERSE_COMPS[comp]
+    operands: Tuple[Value, Value] = (compare.use_value.value1, compare.use_value.value2)
+    if isinstance(operands[0], Const):
+        operands = (operands[1], operands[0])
+        comp = SWAPPED_COMPS[comp]
+    reg: Value = operands[0]
+    if not isinstance(reg, VirtualRegister) or not isinstance(operands[1], Const):
+        return None
+    bound: int = operands[1].value
+
+    induction: Optional[Tuple[SetInsn, Block, int]] = induction_step(loop, reg)
+    if induction is None:
+        return None
+    update, update_block, step = induction
+
+    # Both have to run exactly once on every trip around the loop, so
+    # neither may sit in a loop nested inside it
+    if test_block.innermost is not loop or update_block.innermost is not loop:
+        return None
+    latches: List[Block] = [
+        edge.start for edge in loop.header.in_edges if edge.start in loop.body
+    ]
+    if not all(
+        dominates(test_block, latch) and dominates(update_block, latch)
+        for latch in latches
+    ):
+        return None
+
+    entries: List[Block] = [
+        edge.start for edge in loop.header.in_edges if edge.start not in loop.body
+    ]
+    starts: Set[Optional[int]] = set(initial_value(entry, reg) for entry in entries)
+    if len(starts) != 1 or None in starts:
+        return None
+    first: int = cast(int, starts.pop())
+
+    if update_block is test_block:
+        if test_block.rtls.precedes(update, compare):
+            first += step
+    elif dominates(update_block, test_block):
+        first += step
+
+    # Unsigned comparisons are only followed while nothing wraps
+    unsigned: bool = comp.endswith("u")
+    if unsigned:
+        comp = comp[ : -1]
+    tests: Optional[int] = count_tests(first, step, comp, bound)
+    if (
+        unsigned
+        and tests is not None
+        and min(first, bound, first + (tests - 1) * step) < 0
+    ):
+        return None
+    return tests
 
 
+# Assumed runs per entry of a loop with no trip count to go by and whose
+# back edges look to be always taken
 ITER_COUNT: int = 100
 def compute_expect(
-    vertices: List[Vertex]
-) -> None:
-    dominance(vertices)
-    loop_headers: Set[Vertex] = identify_backedge(vertices)
-    vertices[0].expect = 1.0
-    change = True
-    
-    while change:
-        change = False
-        for vertex in vertices[1 : ]:
-            if vertex in loop_headers: # Only identified natural loops for one entry
-                for edge in vertex.in_edges:
-                    if edge.edge_type == Edge.EdgeType.SEQUENTIAL:
-                        new_expect: float = ITER_COUNT * edge.start.expect
-                        vertex.expects[edge.start] = new_expect
-            else: # Not a loop header
-                new_expect: float = 0.0
-                edges: List[Edge] = list()
-                for edge in vertex.in_edges:
-                    if not any(
-                        [isinstance(next_edge.end, LoopPreheader) for next_edge in edge.start.out_edges]
-                    ):
-                        edges.append(edge)
-                for edge in edges:
-                    if edge.edge_type == Edge.EdgeType.SEQUENTIAL:
-                        if isinstance(edge.start.rtl, ConditionalJump):
-                            temp_expect: float = (1 - edge.start.rtl.prob) * edge.start.expect
-                            new_expect += temp_expect
-                            vertex.expects[edge.start] = temp_expect
-                        else:
-                            new_expect += edge.start.expect
-                            vertex.expects[edge.start] = edge.start.expect
-                    elif edge.edge_type == Edge.EdgeType.JUMP:
-                        if isinstance(edge.start.rtl, ConditionalJump):
-                            temp_expect: float = edge.start.rtl.prob * edge.start.expect
-                            new_expect += temp_expect
-                            vertex.expects[edge.start] = temp_expect
-                        else:
-                            new_expect += edge.start.expect
-                            vertex.expects[edge.start] = edge.start.expect
-            
-            if new_expect != vertex.expect:
-                change = True
+    blocks: List[Block]
+) -> List[Loop]:
+    dominance(blocks)
+    loops: List[Loop] = identify_loops(blocks)
+    insert_preheaders(blocks, loops)
+    guess_probabilities(blocks)
+
+    order: List[Block] = reverse_postorder(blocks)
+    rpo: Dict[Block, int] = {block: idx for (idx, block) in enumerate(order)}
+    loop: Loop
+    block: Block
+    edge: Edge
+
+    # Innermost loops first, relative to one entry into the header
+    for loop in reversed(loops):
+        # An exact trip count beats a guessed or compiler noted probability
+        # of the exit test, only a measured one is kept
+        loop.trip_count = estimate_trip_count(loop)
+        if loop.trip_count is not None:
+            exit_edge: Edge = loop.exits[0]
+            exit_jump: ConditionalJump = cast(ConditionalJump, exit_edge.start.last)
+            if not exit_jump.measured:
+                # The exit test then leaves on exactly one of its runs
+                leave: float = 1 / loop.trip_count
+                exit_jump.prob = (
+                    leave if exit_edge.edge_type == Edge.EdgeType.JUMP else 1 - leave
+                )
+                loop.iterations = loop.trip_count
+                continue
+
+        body: List[Block] = sorted(
+            (block for block in loop.body if block in rpo),
+            key=lambda block: rpo[block]
+        )
+        local: Dict[Block, float] = propagate_expect(body, 1.0)
 
-            vertex.expect = new_expect
+        back_prob: float = 0.0
+        for edge in loop.header.in_edges:
+            if edge.start in loop.body and edge.start in local:
+                back_prob += local[edge.start] * edge_probability(edge)
+
+        if back_prob >= 1 - 1 / ITER_COUNT:
+            loop.iterations = ITER_COUNT
+        else:
+            loop.iterations = 1 / (1 - back_prob)
+
+    expects: Dict[Block, float] = propagate_expect(order, 1.0)
+    for block in blocks:
+        block.expect = expects.get(block, 0.0)
+        block.expects = EMPTY_EXPECTS
+
+    # Flow along each forward edge, what trace selection compares
+    for block in order[1 : ]:
+        for edge in block.in_edges:
+            if block.is_header and edge.start in cast(Loop, block.innermost).body:
+                continue
+            flow: float = edge.start.expect * edge_probability(edge)
+            if block.is_header:
+                flow *= cast(Loop, block.innermost).iterations
+            block.add_expect(edge.start, block.expects.get(edge.start, 0.0) + flow)
+
+    return loops
@@ -0,0 +1,197 @@
+from typing import Dict, List, Optional, Set, Tuple
+
+from graph import *
+from rtl import *
+
+# A block that runs less often than this per call of the function is cold
+COLD_EXPECT: float = 0.05
+
+# Rarely run blocks and the paths into exit() and abort()
+def is_cold(
+    block: Block
+) -> bool:
+    return (
+        block.expect < COLD_EXPECT
+        or (isinstance(block.last, Call) and cast(Call, block.last).is_exit_func())
+    )
+
+
+# The block control falls into when the last instruction does not jump
+def fallthrough(
+    block: Block
+) -> Optional[Block]:
+    edge: Edge
+    for edge in block.out_edges:
+        if edge.edge_type == Edge.EdgeType.SEQUENTIAL:
+            return edge.end
+    return None
+
+
+# Whether control can run off the last block into the epilogue
+def runs_off_end(
+    blocks: List[Block]
+) -> bool:
+    last: RTL = blocks[-1].last
+    return isinstance(last, ConditionalJump) or not ends_block(last)
+
+
+# Chains blocks along the most frequent edges (Pettis and Hansen), a block
+# that does not end in a jump stays glued to the block it falls into
+def build_chains(
+    blocks: List[Block]
+) -> Dict[Block, List[Block]]:
+    chain_of: Dict[Block, List[Block]] = {block: [block] for block in blocks}
+    block: Block
+    edge: Edge
+
+    def merge(
+        start: Block,
+        end: Block
+    ) -> None:
+        chain: List[Block] = chain_of[start]
+        other: List[Block] = chain_of[end]
+        chain.extend(other)
+        for block in other:
+            chain_of[block] = chain
+
+    for block in blocks:
+        next_block: Optional[Block] = fallthrough(block)
+        if not isinstance(block.last, Jump) and next_block is not None:
+            merge(block, next_block)
+
+    edges: List[Edge] = [
+        edge
+        for block in blocks if isinstance(block.last, Jump)
+        for edge in block.out_edges
+    ]
+    # On a tie keep the fall through the code already has
+    edges.sort(
+        key=lambda edge: (
+            edge.start.expect * edge_probability(edge),
+            edge.edge_type == Edge.EdgeType.SEQUENTIAL
+        ),
+        reverse=True
+    )
+
+    for edge in edges:
+        if (
+            chain_of[edge.start] is not chain_of[edge.end]
+            and chain_of[edge.start][-1] is edge.start
+            and chain_of[edge.end][0] is edge.end
+            and edge.end is not blocks[0]
+        ):
+            merge(edge.start, edge.end)
+
+    return chain_of
+
+
+# Entry chain first, then the hot chains, then the cold ones, and last the
+# chain that runs off the end into the epilogue
+def order_blocks(
+    blocks: List[Block]
+) -> List[Block]:
+    chain_of: Dict[Block, List[Block]] = build_chains(blocks)
+    entry: List[Block] = chain_of[blocks[0]]
+    last: Optional[List[Block]] = None
+    if runs_off_end(blocks):
+        last = chain_of[blocks[-1]]
+
+    hot: List[List[Block]] = []
+    cold: List[List[Block]] = []
+    seen: Set[int] = {id(entry)}
+    if last is not None:
+        seen.add(id(last))
+
+    for block in blocks:
+        chain: List[Block] = chain_of[block]
+        if id(chain) in seen:
+            continue
+        seen.add(id(chain))
+
+        if all(is_cold(block) for block in chain):
+            cold.append(chain)
+        else:
+            hot.append(chain)
+
+    chains: List[List[Block]] = [entry] + hot + cold
+    if last is not None and last is not entry:
+        chains.append(last)
+
+    return [block for chain in chains for block in chain]
+
+
+# Lays the blocks out and fixes up the branches, inverting a conditional
+# jump when its target now follows and adding jumps where a fall through
+# was broken
+def layout_blocks(
+    blocks: List[Block]
+) -> List[RTL]:
+    order: List[Block] = order_blocks(blocks)
+    labels: Dict[int, Block] = {
+        block.first.this_insn: block for block in blocks if isinstance(block.first, Label)
+    }
+    block: Block
+    next_block: Optional[Block]
+    target: Optional[Block]
+    falls_to: Optional[Block]
+
+    # (block, what to do, block the new branch goes to or None for the end)
+    fixups: List[Tuple[Block, str, Optional[Block]]] = []
+    for idx, block in enumerate(order):
+        next_block = order[idx + 1] if idx + 1 < len(order) else None
+        falls_to = fallthrough(block)
+
+        # Running off the end reaches the epilogue, which then needs a label
+        if block is blocks[-1] and runs_off_end(blocks):
+            if next_block is not None:
+                fixups.append((block, "jump", None))
+
+        elif isinstance(block.last, ConditionalJump):
+            target = labels.get(block.last.jump_loc)
+            if falls_to is None or next_block is falls_to:
+                continue
+            if next_block is target and block.last.can_invert():
+                fixups.append((block, "invert", falls_to))
+            else:
+                fixups.append((block, "jump", falls_to))
+
+        elif isinstance(block.last, Jump):
+            if next_block is labels.get(block.last.jump_loc):
+                fixups.append((block, "drop", None))
+
+        elif falls_to is not None and next_block is not falls_to:
+            fixups.append((block, "jump", falls_to))
+
+    # Branches can only go to labels, blocks entered by falling through get one
+    next_uid: int = max(rtl.this_insn for block in blocks for rtl in block.rtls) + 1
+    new_labels: Dict[Block, int] = dict()
+    end: Optional[Label] = None
+    for (_, action, target) in fixups:
+        if action == "jump" and target is None and end is None:
+            end = Label(next_uid, order[-1].basic_block)
+            next_uid += 1
+        if target is None or target in new_labels:
+            continue
+        if isinstance(target.first, Label):
+            new_labels[target] = target.first.this_insn
+        else:
+            target.rtls.insert_before(target.first, Label(next_uid, target.basic_block))
+            new_labels[target] = next_uid
+            next_uid += 1
+
+    for (block, action, target) in fixups:
+        if action == "invert":
+            cast(ConditionalJump, block.last).invert(new_labels[cast(Block, target)])
+        elif action == "jump":
+            jump_loc: int = (
+                cast(Label, end).this_insn if target is None else new_labels[target]
+            )
+            block.rtls.append(Jump(next_uid, block.basic_block, jump_loc))
+            next_uid += 1
+        else:
+            block.rtls.remove(block.last)
+
+    rtls: List[RTL] = list(instructions(order))
+    if end is not None:
+        rtls.append(end)
+    return rtls
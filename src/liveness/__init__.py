@@ -1,7 +1,8 @@
-from copy import deepcopy
-from typing import Set, List, Dict, TypeVar, Generic, Optional
+from heapq import heapify, heappop, heappush
+from typing import Set, List, Dict, Optional, Tuple
 
 from graph import *
+from dataflow import Problem, Solution, solve
 from rtl import *
 from rtl.value import *
 from rtl.registers import ArchitectureRegisters as AR
@@ -9,282 +10,332 @@ from rtl.registers import ArchitectureRegisters as AR
 NUM_COLORS: int = len(AR.REAL_REGISTERS_NUM)
 COLORS: Set[int] = set(i for i in range(NUM_COLORS))
 
-T = TypeVar("T")
+# Interference graph over the ids of a function's RegisterTable, each row
+# a bitset of the neighbours of one register, grown as spills add registers
+class InterferenceGraph:
 
-class Matrix(Generic[T]):
+    __slots__ = ("registers", "rows", "degree", "nodes")
 
     def __init__(
-        self
+        self,
+        registers: RegisterTable
     ) -> None:
-        self.matrix: List[List[int]] = []
-        self.dim: int = 0
-        self.node_to_row: Dict[T,int] = dict()
-        self.row_to_node: Dict[int,T] = dict()
-
-        self.is_deleted: bool = False 
-        self.delete_matrix: List[List[int]]
-        self.deleted: Set[int]
-        self.num_colors: int
-        self.delete_dim: int
+        self.registers: RegisterTable = registers
+        self.rows: List[int] = [0] * len(registers)
+        self.degree: List[int] = [0] * len(registers)
+        self.nodes: int = 0
 
     def add_node(
-        self, 
-        node: T
+        self,
+        node: Register
     ) -> None:
-        assert(not self.is_deleted)
+        self.add_clique(1 << node.id)
+
+    def add_edge(
+        self,
+        node1: Register,
+        node2: Register
+    ):
+        self.add_clique((1 << node1.id) | (1 << node2.id))
 
-        if node in self:
+    # Makes every register of the bitset interfere with every other one
+    def add_clique(
+        self,
+        mask: int
+    ) -> None:
+        if mask.bit_length() > len(self.rows):
+            missing: int = len(self.registers) - len(self.rows)
+            self.rows.extend([0] * missing)
+            self.degree.extend([0] * missing)
+
+        self.nodes |= mask
+        for id in RegisterTable.ids(mask):
+            new: int = mask & ~self.rows[id] & ~(1 << id)
+            if new != 0:
+                self.rows[id] |= new
+                self.degree[id] += bin(new).count("1")
+
+    def drop_node(
+        self,
+        node: Register
+    ) -> None:
+        if node not in self:
             return
 
-        self.dim += 1
+        bit: int = 1 << node.id
+        for id in RegisterTable.ids(self.rows[node.id]):
+            self.rows[id] &= ~bit
+            self.degree[id] -= 1
+
+        self.rows[node.id] = 0
+        self.degree[node.id] = 0
+        self.nodes &= ~bit
+
+    # Order to take the nodes out in for coloring (Chaitin, pushing a node
+    # of high degree optimistically as Briggs does): the lowest id with
+    # fewer neighbours left than colors, failing that the lowest id with the
+    # most neighbours left. Low nodes wait in a heap and high ones in buckets
+    # by degree, degrees only fall so each removal costs its degree.
+    def simplify(
+        self,
+        num_colors: int
+    ) -> List[int]:
+        left: List[int] = list(self.degree)
+        low: List[int] = []
+        # A heap of ids per degree, a node is left behind in its old bucket
+        # when its degree drops and skipped once popped from there
+        high: List[List[int]] = [[] for _ in range(max(self.degree, default=0) + 1)]
+        for id in RegisterTable.ids(self.nodes):
+            if left[id] < num_colors:
+                low.append(id)
+            else:
+                high[left[id]].append(id)
+        for bucket in high:
+            heapify(bucket)
+
+        top: int = len(high) - 1
+        remaining: int = self.nodes
+        order: List[int] = []
+        while remaining != 0:
+            if len(low) > 0:
+                id = heappop(low)
+            else:
+                while True:
+                    while len(high[top]) == 0:
+                        top -= 1
+                    id = heappop(high[top])
+                    if left[id] == top:
+                        break
+
+            remaining &= ~(1 << id)
+            order.append(id)
+
+            other: int
+            for other in RegisterTable.ids(self.rows[id] & remaining):
+                degree: int = left[other]
+                left[other] = degree - 1
+                if degree == num_colors:
+                    heappush(low, other)
+                elif degree > num_colors:
+                    heappush(high[degree - 1], other)
+
+        return order
 
-        for row in self.matrix:
-            row.append(0)
+    def interferes_with(
+        self, 
+        node: Register
+    ) -> Set[Register]:
+        assert(node in self)
 
-        new_row: List[int] = [0 for _ in range(self.dim)]
-        self.matrix.append(new_row)
+        return set(self.registers.members(self.rows[node.id]))
 
-        self.node_to_row[node] = self.dim - 1
-        self.row_to_node[self.dim - 1] = node
+    def __contains__(
+        self, 
+        node: Register
+    ) -> bool:
+        return node.id >= 0 and (self.nodes >> node.id) & 1 == 1
 
-    def remove_node(
+    def __len__(
         self
-    ) -> T:
-        assert(self.is_deleted)
-
-        found: bool = False
-        found_row_num: int
-        row_num: int = 0
-        max_degree: int = -1
-        while not found and row_num < len(self.delete_matrix):
-            if row_num in self.deleted:
-                row_num += 1
-                continue
-
-            degree: int = sum(self.delete_matrix[row_num])
-            if degree < self.num_colors:
-                found = True
-                found_row_num = row_num
-            elif degree > max_degree:
-                max_degree = degree
-                found_row_num = row_num
+    ) -> int:
+        return bin(self.nodes).count("1")
 
-            row_num += 1
 
-        self.delete_dim -= 1
-        self.deleted.add(found_row_num)
-        for i in range(self.dim):
-            self.delete_matrix[found_row_num][i] = 0
-            self.delete_matrix[i][found_row_num] = 0
+# What spilling a register rewrote, the blocks it occurred in and the short
+# lived registers that took its place
+class Spill:
 
-        return self.row_to_node[found_row_num]
+    __slots__ = ("reg", "blocks", "temps")
 
-    def init_coloring(
-        self, 
-        num_colors: int
+    def __init__(
+        self,
+        reg: VirtualRegister
     ) -> None:
-        self.is_deleted = True
-        self.delete_matrix = deepcopy(self.matrix)
-        self.deleted = set()
-        self.num_colors = num_colors
-        self.delete_dim = self.dim
+        self.reg: VirtualRegister = reg
+        self.blocks: List[Block] = []
+        self.temps: Set[VirtualRegister] = set()
+
+    def add(
+        self,
+        block: Block,
+        temp: VirtualRegister
+    ) -> None:
+        if len(self.blocks) == 0 or self.blocks[-1] is not block:
+            self.blocks.append(block)
+        self.temps.add(temp)
 
-    def add_edge(
-        self, 
-        node1: T, 
-        node2: T
-    ):
-        assert(not self.is_deleted)
 
-        for node in [node1, node2]:
-            self.add_node(node)
+# Compute live in and live out of every block, a backward problem whose
+# facts are registers
+def compute_liveness(
+    blocks: List[Block]
+):
+    # Summarize each block once, the solver runs over blocks
+    for block in blocks:
+        block.init_liveness()
+
+    solution: Solution = solve(
+        blocks,
+        Problem(
+            Problem.Direction.BACKWARD,
+            True,
+            {block: block.uses for block in blocks},
+            {block: block.defs for block in blocks}
+        )
+    )
 
-        row1: int = self.node_to_row[node1]
-        row2: int = self.node_to_row[node2]
+    for block in blocks:
+        block.live_in = solution.block_in[block]
+        block.live_out = solution.block_out[block]
 
-        self.matrix[row1][row2] = 1
-        self.matrix[row2][row1] = 1
 
-    def interferes_with(
-        self, 
-        node: T
-    ) -> Set[T]:
-        assert(node in self)
+# Builds the interference graph using liveness, the registers live into
+# an instruction all interfere and a call clobbers the caller save ones
+def interference_graph(
+    blocks: List[Block],
+    registers: RegisterTable
+) -> InterferenceGraph:
+    graph: InterferenceGraph = InterferenceGraph(registers)
+    graph.add_clique(REAL_REGISTERS_MASK)
 
-        interfere = set()
+    for block in blocks:
+        for rtl, live_in in zip(block.rtls, block.instruction_live_in()):
+            if isinstance(rtl, Call):
+                live_in |= CALLER_SAVE_MASK
+            graph.add_clique(live_in)
 
-        row_num = self.node_to_row[node]
-        for i in range(len(self.matrix[row_num])):
-            if self.matrix[row_num][i] == 1:
-                interfere.add(self.row_to_node[i])
+    return graph
 
-        return interfere
 
-    def __contains__(
-        self, 
-        node: T
-    ):
-        return node in self.node_to_row
+# Patches liveness after a spill, the spilled register is dead everywhere
+# and the registers that replaced it never live past their block, so only
+# the rewritten blocks need their summaries redone
+def update_liveness(
+    blocks: List[Block],
+    spill: Spill
+) -> None:
+    mask: int = ~(1 << spill.reg.id)
+    for block in blocks:
+        block.live_in &= mask
+        block.live_out &= mask
 
+    for block in spill.blocks:
+        block.summarize_liveness()
+
+
+# Patches the interference graph after a spill with the registers that
+# replaced the spilled one, found in the rewritten blocks. The other
+# registers live at those points already interfere with each other.
+def update_interference(
+    graph: InterferenceGraph,
+    spill: Spill
+) -> None:
+    graph.drop_node(spill.reg)
+
+    temps: int = RegisterTable.mask(spill.temps)
+    for block in spill.blocks:
+        for rtl, live_in in zip(block.rtls, block.instruction_live_in()):
+            if live_in & temps == 0:
+                continue
+            if isinstance(rtl, Call):
+                live_in |= CALLER_SAVE_MASK
+            graph.add_clique(live_in)
 
-# Compute live in and live out until it converges
-def compute_liveness(
-    vertices: List[Vertex]
-):
-    iterate: bool = True
-
-    for vertex in vertices:
-        vertex.rtl.set_defs()
-        vertex.rtl.set_uses()
-        vertex.init_liveness()
-
-    while iterate:
-        iterate = False
-
-        for vertex in reversed(vertices):
-            vertex.compute_live_out()
-            if vertex.compute_live_in():
-                iterate = True
-
-
-# Builds the interference matrix using liveness
-def interference_matrix(
-    vertices: List[Vertex]
-) -> Matrix[Register]:
-    matrix: Matrix[Register] = Matrix()
-
-    real_regs: List[RealRegister] = list(REAL_REGISTERS)
-    for i in range(len(real_regs)):
-        for j in range(i + 1, len(real_regs)):
-            matrix.add_edge(
-                real_regs[i],
-                real_regs[j]
-            )
-
-    for vertex in vertices:
-        live_in_list: List[Register] = list(vertex.live_in)
-        if isinstance(vertex.rtl, Call):
-            live_in_list.extend(list(CALLER_SAVE_REGISTERS))
-
-        for i in range(len(live_in_list)):
-            if live_in_list[i] not in matrix:
-                matrix.add_node(live_in_list[i])
-            for j in range(i + 1, len(live_in_list)):
-                matrix.add_edge(
-                    live_in_list[i],
-                    live_in_list[j]
-                )
-
-    return matrix
 
 class UncolorableError(ValueError):
     pass
 
-# Attempts to color the graph
+# Attempts to color the graph, each node in turn from the last one taken
+# out gets a color none of its colored neighbours has
 def color_graph(
-    matrix: Matrix
+    graph: InterferenceGraph
 ) -> Dict[Register,int]:
-    matrix.init_coloring(NUM_COLORS)
-    colorable: bool = True
+    colors: List[int] = [-1] * len(graph.rows)
     node_to_color: Dict[Register,int] = dict()
 
-    node: Register
-    node_stack: List[Register] = [matrix.remove_node() for _ in range(matrix.dim)]
-    while len(node_stack) > 0 and colorable:
-        node = node_stack.pop()
-        interferes = matrix.interferes_with(node)
+    id: int
+    for id in reversed(graph.simplify(NUM_COLORS)):
         interferes_colors: Set[int] = set(
-            node_to_color[node] for node in interferes if node in node_to_color
+            colors[other] for other in RegisterTable.ids(graph.rows[id])
+            if colors[other] != -1
         )
         color_candidates: Set[int] = COLORS.difference(interferes_colors)
 
         if len(color_candidates) == 0:
-            colorable = False
-        else:
-            node_to_color[node] = color_candidates.pop()
+            raise UncolorableError
 
-    if not colorable:
-        raise UncolorableError
+        colors[id] = color_candidates.pop()
+        node_to_color[graph.registers[id]] = colors[id]
 
     return node_to_color
 
 
-# ID a spill candidate
+# ID a spill candidate and its cost, each use and def counts once per
+# expected trip around the loops it sits in
 def spill_candidate(
-    vertices: List[Vertex]
-) -> VirtualRegister:
-    reg_spill_factor: Dict[VirtualRegister,int] = dict()
-
-    for vertex in vertices:
-        for reg in vertex.rtl.defs.union(vertex.rtl.uses):
-            if (
-                not isinstance(reg, VirtualRegister)
-                or reg.prime != 0
-            ):
-                continue
-            if reg not in reg_spill_factor:
-                reg_spill_factor[reg] = 0
-            reg_spill_factor[reg] += 1 * (2 ** vertex.loop)
+    blocks: List[Block]
+) -> Tuple[VirtualRegister, float]:
+    reg_spill_factor: Dict[VirtualRegister,float] = dict()
+
+    for block in blocks:
+        for rtl in block.rtls:
+            for reg in rtl.defs.union(rtl.uses):
+                if (
+                    not isinstance(reg, VirtualRegister)
+                    or reg.prime != 0
+                ):
+                    continue
+                if reg not in reg_spill_factor:
+                    reg_spill_factor[reg] = 0.0
+                reg_spill_factor[reg] += block.loop_weight
 
     min_reg: VirtualRegister
-    min_spill_factor: int = -1
+    min_spill_factor: float = -1
     for (reg, spill_factor) in reg_spill_factor.items():
         if spill_factor < min_spill_factor or min_spill_factor == -1:
             min_spill_factor = spill_factor
             min_reg = reg
-    min_reg_copy: VirtualRegister = deepcopy(min_reg)
 
-    return min_reg_copy
+    return min_reg, min_spill_factor
 
 
-# Spill the spill candidate
+# Spill the spill candidate, loads and stores stay inside the block
 def spill_register(
-    vertices: List[Vertex], 
-    reg: VirtualRegister
-) -> None:
-    idx: int = 0
+    blocks: List[Block], 
+    reg: VirtualRegister,
+    registers: RegisterTable
+) -> Spill:
+    spill: Spill = Spill(reg)
     new_reg: VirtualRegister
     rtl: RTL
-    new_vertex: Vertex
     prime: int
-    while idx < len(vertices):
-        prime = vertices[idx].rtl.this_insn
-
-        if reg in vertices[idx].rtl.uses:
-            new_reg = VirtualRegister(reg.reg_type, reg.number, prime)
-            vertices[idx].rtl.update_virt_reg(reg, prime)
-            rtl = Load(-1, vertices[idx].rtl.basic_block, new_reg)
-            new_vertex = Vertex(rtl)
-            new_vertex.loop = vertices[idx].loop
-
-            for edge in vertices[idx].in_edges:
-                edge.end = new_vertex
-                new_vertex.in_edges.append(edge)
-
-            vertices[idx].in_edges = []
-            Edge.link(new_vertex, vertices[idx], Edge.EdgeType.SEQUENTIAL)
-
-            vertices.insert(idx, new_vertex)
-            idx += 1
-
-        if reg in vertices[idx].rtl.defs:
-            new_reg = VirtualRegister(reg.reg_type, reg.number, prime)
-            vertices[idx].rtl.update_virt_reg(reg, prime)
-            rtl = Store(-1, vertices[idx].rtl.basic_block, new_reg)
-            new_vertex = Vertex(rtl)
-            new_vertex.loop = vertices[idx].loop
-
-            for edge in vertices[idx].out_edges:
-                edge.start = new_vertex
-                new_vertex.out_edges.append(edge)
-
-            vertices[idx].out_edges = []
-            Edge.link(vertices[idx], new_vertex, Edge.EdgeType.SEQUENTIAL)
-
-            vertices.insert(idx + 1, new_vertex)
-            idx += 2
-        else:
-            idx += 1
+    is_use: bool
+    is_def: bool
+    for block in blocks:
+        # Snapshot, the loads and stores are linked in around each instruction
+        for rtl in list(block.rtls):
+            prime = rtl.this_insn
+            # Rewriting the instruction drops its cached sets, so check both first
+            is_use = reg in rtl.uses
+            is_def = reg in rtl.defs
+
+            if is_use:
+                new_reg = cast(VirtualRegister, registers.intern(
+                    VirtualRegister, reg.reg_type, reg.number, prime
+                ))
+                rtl.update_virt_reg(reg, new_reg)
+                block.rtls.insert_before(rtl, Load(-1, rtl.basic_block, new_reg))
+                spill.add(block, new_reg)
+
+            if is_def:
+                new_reg = cast(VirtualRegister, registers.intern(
+                    VirtualRegister, reg.reg_type, reg.number, prime
+                ))
+                rtl.update_virt_reg(reg, new_reg)
+                block.rtls.insert_after(rtl, Store(-1, rtl.basic_block, new_reg))
+                spill.add(block, new_reg)
+
+    return spill
 
 
 # Maps a color to architecture register
@@ -0,0 +1,234 @@
+from typing import Dict, Generic, Iterable, Iterator, List, Optional, TypeVar
+
+T = TypeVar("T")
+
+# Space left between labels at the end of the list
+LABEL_GAP: int = 1 << 16
+
+# A sequence of distinct items with constant time position queries,
+# items are kept in a linked list of nodes carrying increasing labels
+class OrderedList(Generic[T]):
+
+    class Node(Generic[T]):
+
+        __slots__ = ("item", "prev", "next", "label")
+
+        def __init__(
+            self,
+            item: T,
+            label: int
+        ) -> None:
+            self.item: T = item
+            self.prev: Optional[OrderedList.Node[T]] = None
+            self.next: Optional[OrderedList.Node[T]] = None
+            self.label: int = label
+
+    __slots__ = ("nodes", "head", "tail")
+
+    def __init__(
+        self,
+        items: Iterable[T] = ()
+    ) -> None:
+        self.nodes: Dict[T, OrderedList.Node[T]] = dict()
+        self.head: Optional[OrderedList.Node[T]] = None
+        self.tail: Optional[OrderedList.Node[T]] = None
+
+        for item in items:
+            self.append(item)
+
+    @property
+    def first(
+        self
+    ) -> T:
+        assert(self.head is not None)
+        return self.head.item
+
+    @property
+    def last(
+        self
+    ) -> T:
+        assert(self.tail is not None)
+        return self.tail.item
+
+    def append(
+        self,
+        item: T
+    ) -> None:
+        if self.tail is None:
+            self.link(None, OrderedList.Node(item, 0))
+        else:
+            self.insert_after(self.tail.item, item)
+
+    def insert_after(
+        self,
+        ref: Optional[T],
+        item: T
+    ) -> None:
+        assert(item not in self.nodes)
+
+        if ref is None:
+            if self.head is None:
+                self.link(None, OrderedList.Node(item, 0))
+            else:
+                self.link(None, OrderedList.Node(item, self.head.label - LABEL_GAP))
+            return
+
+        node: OrderedList.Node[T] = self.nodes[ref]
+        if node.next is None:
+            self.link(node, OrderedList.Node(item, node.label + LABEL_GAP))
+            return
+
+        if node.next.label - node.label < 2:
+            self.relabel(node)
+        self.link(node, OrderedList.Node(item, (node.label + node.next.label) // 2))
+
+    def insert_before(
+        self,
+        ref: T,
+        item: T
+    ) -> None:
+        self.insert_after(self.prev(ref), item)
+
+    def remove(
+        self,
+        item: T
+    ) -> None:
+        node: OrderedList.Node[T] = self.nodes.pop(item)
+
+        if node.prev is None:
+            self.head = node.next
+        else:
+            node.prev.next = node.next
+
+        if node.next is None:
+            self.tail = node.prev
+        else:
+            node.next.prev = node.prev
+
+    # Moves the items, in order, to just after ref (the front for None)
+    def splice(
+        self,
+        ref: Optional[T],
+        items: Iterable[T]
+    ) -> None:
+        for item in items:
+            if item is not ref:
+                if item in self.nodes:
+                    self.remove(item)
+                self.insert_after(ref, item)
+            ref = item
+
+    # Comparable between items of the same list, not a dense index
+    def position_of(
+        self,
+        item: T
+    ) -> int:
+        return self.nodes[item].label
+
+    def precedes(
+        self,
+        a: T,
+        b: T
+    ) -> bool:
+        return self.nodes[a].label < self.nodes[b].label
+
+    def next(
+        self,
+        item: T
+    ) -> Optional[T]:
+        node: Optional[OrderedList.Node[T]] = self.nodes[item].next
+        return None if node is None else node.item
+
+    def prev(
+        self,
+        item: T
+    ) -> Optional[T]:
+        node: Optional[OrderedList.Node[T]] = self.nodes[item].prev
+        return None if node is None else node.item
+
+    # Items from start up to but not including stop (the end for None)
+    def between(
+        self,
+        start: Optional[T],
+        stop: Optional[T]
+    ) -> List[T]:
+        items: List[T] = []
+        node: Optional[OrderedList.Node[T]] = (
+            None if start is None else self.nodes[start]
+        )
+        end: Optional[OrderedList.Node[T]] = (
+            None if stop is None else self.nodes[stop]
+        )
+
+        while node is not None and node is not end:
+            items.append(node.item)
+            node = node.next
+
+        return items
+
+    def link(
+        self,
+        prev: Optional['OrderedList.Node[T]'],
+        node: 'OrderedList.Node[T]'
+    ) -> None:
+        self.nodes[node.item] = node
+        node.prev = prev
+
+        if prev is None:
+            node.next = self.head
+            self.head = node
+        else:
+            node.next = prev.next
+            prev.next = node
+
+        if node.next is None:
+            self.tail = node
+        else:
+            node.next.prev = node
+
+    # Spreads the labels after node over the shortest run with room for
+    # them (Dietz and Sleator), so a relabel is amortized over many inserts
+    def relabel(
+        self,
+        node: 'OrderedList.Node[T]'
+    ) -> None:
+        end: Optional[OrderedList.Node[T]] = node.next
+        count: int = 1
+        while end is not None and end.label - node.label <= count * count:
+            end = end.next
+            count += 1
+
+        gap: int = LABEL_GAP if end is None else (end.label - node.label) // count
+        label: int = node.label
+        current: Optional[OrderedList.Node[T]] = node.next
+        while current is not None and current is not end:
+            label += gap
+            current.label = label
+            current = current.next
+
+    def __iter__(
+        self
+    ) -> Iterator[T]:
+        node: Optional[OrderedList.Node[T]] = self.head
+        while node is not None:
+            yield node.item
+            node = node.next
+
+    def __reversed__(
+        self
+    ) -> Iterator[T]:
+        node: Optional[OrderedList.Node[T]] = self.tail
+        while node is not None:
+            yield node.item
+            node = node.prev
+
+    def __len__(
+        self
+    ) -> int:
+        return len(self.nodes)
+
+    def __contains__(
+        self,
+        item: T
+    ) -> bool:
+        return item in self.nodes
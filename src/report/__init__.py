@@ -0,0 +1,166 @@
+from json import dumps
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from graph import *
+from rtl import *
+
+# What the backend believed about one function, kept as plain values so
+# it can come back from a worker process and be written as JSON
+class FunctionReport:
+
+    __slots__ = ("name", "blocks", "loops", "trace", "spills", "schedule")
+
+    def __init__(
+        self,
+        name: str
+    ) -> None:
+        self.name: str = name
+        self.blocks: List[Dict[str, Any]] = []
+        self.loops: List[Dict[str, Any]] = []
+        self.trace: Dict[str, List[int]] = {"insns": [], "blocks": []}
+        self.spills: List[Dict[str, Any]] = []
+        self.schedule: List[int] = []
+
+    # Frequencies, edges and loop nesting of the CFG the code is laid out from
+    def add_blocks(
+        self,
+        blocks: List[Block],
+        loops: List[Loop]
+    ) -> None:
+        index: Dict[Block, int] = {block: idx for (idx, block) in enumerate(blocks)}
+        block: Block
+        edge: Edge
+        loop: Loop
+
+        # Preheaders and spill code have no insn uid of their own
+        def uids(
+            block: Block
+        ) -> List[int]:
+            return [rtl.this_insn for rtl in block.rtls if rtl.this_insn != -1]
+
+        self.blocks = [
+            {
+                "id": index[block],
+                "bb": block.basic_block,
+                "preheader": isinstance(block.first, LoopPreheader),
+                "first": (uids(block) or [None])[0],
+                "last": (uids(block) or [None])[-1],
+                "expect": block.expect,
+                "expects": {
+                    str(index[pred]): flow for (pred, flow) in block.expects.items()
+                    if pred in index
+                },
+                "loop_depth": block.loop,
+                "out_edges": [
+                    {
+                        "to": index[edge.end],
+                        "type": edge.edge_type.name.lower(),
+                        "probability": edge_probability(edge),
+                        "frequency": block.expect * edge_probability(edge)
+                    }
+                    for edge in block.out_edges if edge.end in index
+                ]
+            }
+            for block in blocks
+        ]
+
+        # The trace was picked before scheduling rebuilt the CFG, its blocks
+        # now are the ones holding its instructions, in code order
+        traced: Set[int] = set(self.trace["insns"])
+        self.trace["blocks"] = [
+            index[block] for block in blocks
+            if any(uid in traced for uid in uids(block))
+        ]
+
+        self.loops = [
+            {
+                "header": index[loop.header],
+                "depth": loop.depth,
+                "parent": None if loop.parent is None else index[loop.parent.header],
+                "body": sorted(index[block] for block in loop.body if block in index),
+                "trip_count": loop.trip_count,
+                "iterations": loop.iterations
+            }
+            for loop in loops
+        ]
+
+    # The instructions the trace scheduler picked, the blocks holding them
+    # are filled in with the rest of the CFG
+    def add_trace(
+        self,
+        trace: List[RTL]
+    ) -> None:
+        self.trace = {
+            "insns": [rtl.this_insn for rtl in trace if rtl.this_insn != -1],
+            "blocks": []
+        }
+
+    def add_spill(
+        self,
+        reg: VirtualRegister,
+        cost: float
+    ) -> None:
+        self.spills.append({"register": reg.number, "cost": cost})
+
+    # Final order of the instructions, spill code shows up as -1
+    def add_schedule(
+        self,
+        rtls: List[RTL]
+    ) -> None:
+        self.schedule = [rtl.this_insn for rtl in rtls]
+
+    def to_dict(
+        self
+    ) -> Dict[str, Any]:
+        return {slot: getattr(self, slot) for slot in FunctionReport.__slots__}
+
+
+def to_json(
+    reports: List[FunctionReport]
+) -> str:
+    return dumps([report.to_dict() for report in reports], indent=2) + "\n"
+
+
+# One digraph per function, the blocks of the trace drawn as the hot path
+def to_dot(
+    reports: List[FunctionReport]
+) -> str:
+    lines: List[str] = []
+    report: FunctionReport
+    block: Dict[str, Any]
+    edge: Dict[str, Any]
+
+    for report in reports:
+        hot: Set[int] = set(report.trace["blocks"])
+        path: Set[Tuple[int, int]] = set(zip(report.trace["blocks"], report.trace["blocks"][1 : ]))
+        headers: Set[int] = set(loop["header"] for loop in report.loops)
+
+        lines.append("digraph \"{}\" {{".format(report.name))
+        lines.append("  node [shape=box];")
+        for block in report.blocks:
+            if block["preheader"]:
+                label: str = "preheader"
+            else:
+                label = "bb {}\\ninsns {}-{}".format(block["bb"], block["first"], block["last"])
+            attrs: List[str] = [
+                "label=\"{}\\nexpect {:.3g}\"".format(label, block["expect"])
+            ]
+            if block["id"] in hot:
+                attrs.append("style=filled, fillcolor=salmon")
+            if block["id"] in headers:
+                attrs.append("peripheries=2")
+            lines.append("  b{} [{}];".format(block["id"], ", ".join(attrs)))
+
+        for block in report.blocks:
+            for edge in block["out_edges"]:
+                attrs = ["label=\"{:.3g}\"".format(edge["frequency"])]
+                if edge["type"] == "jump":
+                    attrs.append("style=dashed")
+                if (block["id"], edge["to"]) in path:
+                    attrs.append("color=red, penwidth=2")
+                lines.append("  b{} -> b{} [{}];".format(
+                    block["id"], edge["to"], ", ".join(attrs)
+                ))
+        lines.append("}")
+
+    return "\n".join(lines) + "\n"
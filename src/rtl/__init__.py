@@ -7,20 +7,30 @@ from rtl.registers import ArchitectureRegisters as AR
 
 
 func_name: str
+# Every RegisterTable interns the real registers first, so these have the
+# same ids in all of them
+ARCHITECTURE_REGISTERS: RegisterTable = RegisterTable()
 CALLER_SAVE_REGISTERS: Set[CallerSaveRegister] = set(
-    CallerSaveRegister(Type.SI, number, None)
+    cast(CallerSaveRegister, ARCHITECTURE_REGISTERS[number])
     for number in AR.CALLER_SAVE_REGISTERS_NUM
 )
 CALLEE_SAVE_REGISTERS: Set[RealRegister] = set(
-    RealRegister(Type.SI, number, None)
+    cast(RealRegister, ARCHITECTURE_REGISTERS[number])
     for number in AR.CALLEE_SAVE_REGISTERS_NUM
 )
 REAL_REGISTERS: Set[RealRegister] = CALLEE_SAVE_REGISTERS.union(
     CALLER_SAVE_REGISTERS
 )
+CALLER_SAVE_MASK: int = RegisterTable.mask(CALLER_SAVE_REGISTERS)
+REAL_REGISTERS_MASK: int = RegisterTable.mask(REAL_REGISTERS)
 
 
 class RTL:
+
+    __slots__ = ("this_insn", "basic_block", "_defs", "_uses", "_def_mask", "_use_mask")
+
+    # rtx codes of the top-level forms the backend keeps
+    INSN_CODES: Set[str] = {"insn", "jump_insn", "call_insn", "code_label"}
     
     def __init__(
         self, 
@@ -30,18 +40,84 @@ class RTL:
         self.this_insn: int = this_insn
         self.basic_block: int = basic_block
 
-        self.defs: Set[Register]
-        self.uses: Set[Register]
+        # Computed from the values on first use and kept until the
+        # instruction changes
+        self._defs: Optional[Set[Register]] = None
+        self._uses: Optional[Set[Register]] = None
+        self._def_mask: Optional[int] = None
+        self._use_mask: Optional[int] = None
+
+    def compute_defs(
+        self
+    ) -> Set[Register]:
+        return set()
+
+    def compute_uses(
+        self
+    ) -> Set[Register]:
+        return set()
+
+    @property
+    def defs(
+        self
+    ) -> Set[Register]:
+        if self._defs is None:
+            self._defs = self.compute_defs()
+
+        return self._defs
+
+    @defs.setter
+    def defs(
+        self, 
+        defs: Set[Register]
+    ) -> None:
+        self._defs = defs
+        self._def_mask = None
 
-    def set_defs(
+    @property
+    def uses(
         self
+    ) -> Set[Register]:
+        if self._uses is None:
+            self._uses = self.compute_uses()
+
+        return self._uses
+
+    @uses.setter
+    def uses(
+        self, 
+        uses: Set[Register]
     ) -> None:
-        self.defs = set()
+        self._uses = uses
+        self._use_mask = None
+
+    # The defs and uses as bitsets over the ids of the RegisterTable, what
+    # liveness kills and generates
+    @property
+    def def_mask(
+        self
+    ) -> int:
+        if self._def_mask is None:
+            self._def_mask = RegisterTable.mask(self.defs)
 
-    def set_uses(
+        return self._def_mask
+
+    @property
+    def use_mask(
+        self
+    ) -> int:
+        if self._use_mask is None:
+            self._use_mask = RegisterTable.mask(self.uses)
+
+        return self._use_mask
+
+    def invalidate(
         self
     ) -> None:
-        self.uses = set()
+        self._defs = None
+        self._uses = None
+        self._def_mask = None
+        self._use_mask = None
 
     @staticmethod
     def get_(
@@ -58,17 +134,19 @@ class RTL:
 
         return ret
 
+    # Map the registers of the instruction, starting over from its values
+    # so the sets are never mapped twice
     def set_defs_reg(
         self, 
         register_mapping: Optional[RegMap]=None
     ) -> None:
-        self.defs = RTL.get_(self.defs, register_mapping)
+        self.defs = RTL.get_(self.compute_defs(), register_mapping)
 
     def set_uses_reg(
         self, 
         register_mapping: Optional[RegMap]=None
     ) -> None:
-        self.uses = RTL.get_(self.uses, register_mapping)
+        self.uses = RTL.get_(self.compute_uses(), register_mapping)
 
     def get_defs(
         self
@@ -87,33 +165,41 @@ class RTL:
     ) -> List[str]:
         return []
 
+    # Replaces every occurrence of reg in the instruction by new_reg. The
+    # cached sets are only dropped when the instruction mentions reg.
     def update_virt_reg(
         self, 
         reg: Value, 
-        prime: int
+        new_reg: VirtualRegister
+    ) -> None:
+        if reg in self.defs or reg in self.uses:
+            self.replace_virt_reg(reg, new_reg)
+            self.invalidate()
+
+    def replace_virt_reg(
+        self, 
+        reg: Value, 
+        new_reg: VirtualRegister
     ) -> None:
         pass
         
     @staticmethod
     def factory(
-        rtl_sexp: List[Any]
+        rtl_sexp: List[Any],
+        registers: RegisterTable
     ) -> List['RTL']:
         rtl_repr: List['RTL'] = []
 
         try:
             insn_type, this_insn, _, _, basic_block, *rest = rtl_sexp
-            insn_type: str = str(insn_type).lower()
-            insn_classes: Dict[str,'RTL'] = dict(
-                insn=Insn,
-                jump_insn=Jump,
-                call_insn=Call,
-                code_label=Label
+            insn_class: Optional[Any] = INSN_CLASSES.get(
+                decode_rtx(str(insn_type)).code
             )
 
-            try:
-                rtl_repr.append(insn_classes[insn_type].factory(this_insn, basic_block, rest))
-            except KeyError:
-                pass
+            if insn_class is not None:
+                rtl_repr.append(
+                    insn_class.factory(int(this_insn), int(basic_block), rest, registers)
+                )
         except ValueError:
             pass
 
@@ -121,7 +207,9 @@ class RTL:
 
 
 class Insn(RTL):
-        
+
+    __slots__ = ("use_value",)
+
     def __init__(
         self, 
         this_insn: int, 
@@ -131,20 +219,20 @@ class Insn(RTL):
         super(Insn, self).__init__(this_insn, basic_block)
         self.use_value: Value = use_value
 
-    def set_uses(
+    def compute_uses(
         self
-    ) -> None:
-        self.uses = self.use_value.get_uses()
+    ) -> Set[Register]:
+        return self.use_value.get_uses()
 
-    def update_virt_reg(
+    def replace_virt_reg(
         self, 
         reg: Value, 
-        prime: int
+        new_reg: VirtualRegister
     ) -> None:
-        self.use_value.update_virt_reg(reg, prime)
+        self.use_value = self.use_value.update_virt_reg(reg, new_reg)
 
     @staticmethod
-    def factory(this_insn: int, basic_block: int, rest: List[Any]):
+    def factory(this_insn: int, basic_block: int, rest: List[Any], registers: RegisterTable):
         insn = None
         instruction = rest[0]
         use_sexp = None
@@ -155,22 +243,24 @@ class Insn(RTL):
             insn = SetInsn(
                 this_insn,
                 basic_block,
-                Value.factory(def_sexp),
-                Value.factory(use_sexp)
+                Value.factory(def_sexp, registers),
+                Value.factory(use_sexp, registers)
             )
         except ValueError: # Use instruction
             _, use_sexp = instruction
             insn = Insn(
                 this_insn,
                 basic_block,
-                Value.factory(use_sexp)
+                Value.factory(use_sexp, registers)
             )
 
         return insn
 
 
 class SetInsn(Insn):
-    
+
+    __slots__ = ("def_value",)
+
     def __init__(
         self, 
         this_insn: int, 
@@ -181,26 +271,28 @@ class SetInsn(Insn):
         super(SetInsn, self).__init__(this_insn, basic_block, use_value)
         self.def_value: Value = def_value
 
-    def set_defs(
+    def compute_defs(
         self
-    ) -> None:
-        self.defs = self.def_value.get_defs()
+    ) -> Set[Register]:
+        return self.def_value.get_defs()
 
-    def set_uses(
+    def compute_uses(
         self
-    ) -> None:
-        super(SetInsn, self).set_uses()
+    ) -> Set[Register]:
+        uses: Set[Register] = super(SetInsn, self).compute_uses()
 
         if isinstance(self.def_value, Memory):
-            self.uses.update(self.def_value.get_uses())
+            uses.update(self.def_value.get_uses())
 
-    def update_virt_reg(
+        return uses
+
+    def replace_virt_reg(
         self, 
         reg: Value, 
-        prime: int
+        new_reg: VirtualRegister
     ) -> None:
-        super(SetInsn, self).update_virt_reg(reg, prime)
-        self.def_value.update_virt_reg(reg, prime)
+        super(SetInsn, self).replace_virt_reg(reg, new_reg)
+        self.def_value = self.def_value.update_virt_reg(reg, new_reg)
 
     def asm(
         self, 
@@ -256,7 +348,9 @@ class SetInsn(Insn):
 
 
 class Jump(RTL):
-    
+
+    __slots__ = ("jump_loc",)
+
     def __init__(
         self, 
         this_insn: int, 
@@ -278,7 +372,7 @@ class Jump(RTL):
         ]
         
     @staticmethod
-    def factory(this_insn: int, basic_block: int, rest: List[Any]):
+    def factory(this_insn: int, basic_block: int, rest: List[Any], registers: RegisterTable):
         jump = None
         jump_loc = None
         _, _, locs = rest[0]
@@ -286,24 +380,36 @@ class Jump(RTL):
         try: # Conditional jump
             _, comp_sexp, jump_taken, _ = locs
             _, jump_loc = jump_taken
-            rest = flatten_list(rest)
-            for idx, element in enumerate(rest):
-                if ConditionalJump.REG_PROB_NAME in str(element):
-                    break
-            else:
-                raise AssertionError("Conditional jump must have branch probability")
-            jump = ConditionalJump(this_insn, basic_block, jump_loc, comp_sexp[0], int(rest[idx + 1]))
+            note: Optional[List[Any]] = find_note(rest, ConditionalJump.REG_PROB_NAME)
+            jump = ConditionalJump(
+                this_insn,
+                basic_block,
+                int(jump_loc),
+                comp_sexp[0],
+                None if note is None else int(note[1])
+            )
         except ValueError: # Unconditional jump
             _, jump_loc = locs
-            jump = Jump(this_insn, basic_block, jump_loc)
+            jump = Jump(this_insn, basic_block, int(jump_loc))
             
         return jump
 
 
 class ConditionalJump(Jump):
 
+    __slots__ = ("comp", "prob", "guessed", "measured")
+
     REG_PROB_NAME = "REG_BR_PROB"
     REG_BR_PROB_MAX = 10_000
+
+    # The comparison that holds exactly when the key does not
+    INVERSE_COMPS: Dict[str,str] = {
+        "eq": "ne", "ne": "eq",
+        "gt": "le", "le": "gt",
+        "ge": "lt", "lt": "ge",
+        "gtu": "leu", "leu": "gtu",
+        "geu": "ltu", "ltu": "geu"
+    }
     
     def __init__(
         self, 
@@ -311,11 +417,31 @@ class ConditionalJump(Jump):
         basic_block: int, 
         jump_loc: int, 
         comp: str,
-        br_prob: int
+        br_prob: Optional[int]
     ) -> None:
         super(ConditionalJump, self).__init__(this_insn, basic_block, jump_loc)
         self.comp: str = comp.lower()
-        self.prob: float = br_prob / ConditionalJump.REG_BR_PROB_MAX
+        # Without a note the probability is guessed once the CFG is built
+        self.guessed: bool = br_prob is None
+        # Set once a profile replaces the static probability
+        self.measured: bool = False
+        self.prob: float = (
+            0.5 if br_prob is None else br_prob / ConditionalJump.REG_BR_PROB_MAX
+        )
+
+    def can_invert(
+        self
+    ) -> bool:
+        return self.comp in ConditionalJump.INVERSE_COMPS
+
+    # Branch on the opposite condition to the block that used to fall through
+    def invert(
+        self,
+        jump_loc: int
+    ) -> None:
+        self.comp = ConditionalJump.INVERSE_COMPS[self.comp]
+        self.jump_loc = jump_loc
+        self.prob = 1 - self.prob
 
     def asm(
         self, 
@@ -332,6 +458,8 @@ class ConditionalJump(Jump):
 
 class Call(RTL):
 
+    __slots__ = ("func_name",)
+
     EXIT_FUNCS: Set[str] = {"exit", "abort"}
 
     def __init__(
@@ -360,39 +488,67 @@ class Call(RTL):
     ) -> bool:
         return self.func_name in Call.EXIT_FUNCS
 
+    # Name of the symbol called by a call pattern, if it is a direct call:
+    # (call (mem (symbol_ref ("name") ...)) ...), possibly inside a set or
+    # a parallel
     @staticmethod
-    def factory(this_insn: int, basic_block: int, rest: List[Any]):
-        func_name = None
-        flattened = flatten_list(rest)
-        idx = 0
-
-        while func_name is None and idx < len(flattened) - 1:
-            if (isinstance(flattened[idx], str) and 
-                    "symbol_ref" in flattened[idx].lower()):
-                func_name = flattened[idx + 1]
+    def call_target(
+        pattern: List[Any]
+    ) -> Optional[str]:
+        func_name: Optional[str] = None
+        code: str = decode_rtx(str(pattern[0])).code
+
+        if code == "parallel":
+            for element in pattern[1]:
+                func_name = Call.call_target(element)
+                if func_name is not None:
+                    break
+        elif code == "set":
+            func_name = Call.call_target(pattern[2])
+        elif code == "call":
+            _, addr, *_ = pattern[1]
+            if (
+                isinstance(addr, (list, tuple))
+                and decode_rtx(str(addr[0])).code == "symbol_ref"
+            ):
+                symbol = addr[1]
+                func_name = str(symbol[0] if isinstance(symbol, (list, tuple)) else symbol)
+
+        return func_name
 
-            idx += 1
+    @staticmethod
+    def factory(this_insn: int, basic_block: int, rest: List[Any], registers: RegisterTable):
+        func_name = Call.call_target(rest[0])
 
         assert(func_name is not None)
         return Call(this_insn, basic_block, func_name)
 
 
-def flatten_list(
-    deep_list: List[Any]
-) -> List[Any]:
-    flattened: List[Any] = []
+# The REG_NOTES of an insn are the first list after its pattern. Each note
+# is (kind:NOTE datum next) and the chain ends with (nil).
+def find_note(
+    rest: List[Any], 
+    note_name: str
+) -> Optional[List[Any]]:
+    note: Optional[List[Any]] = next(
+        (element for element in rest[1 : ] if isinstance(element, (list, tuple))),
+        None
+    )
 
-    for element in deep_list:
-        if isinstance(element, (list, tuple)):
-            flattened += flatten_list(element)
-        else:
-            flattened.append(element)
-    
-    return flattened
+    while note is not None and len(note) == 3:
+        if decode_rtx(str(note[0])).mode == note_name:
+            break
+        note = note[2]
+    else:
+        note = None
+
+    return note
 
 
 class Label(RTL):
 
+    __slots__ = ()
+
     def __init__(
         self, 
         this_insn: int, 
@@ -420,12 +576,14 @@ class Label(RTL):
         return "L{}_{}".format(insn_number, func_name)
 
     @staticmethod
-    def factory(this_insn: int, basic_block: int, rest: List[Any]):
+    def factory(this_insn: int, basic_block: int, rest: List[Any], registers: RegisterTable):
         return Label(this_insn, basic_block)
 
 
 class Stack(RTL):
 
+    __slots__ = ("value",)
+
     def __init__(
         self, 
         this_insn: int, 
@@ -463,6 +621,8 @@ class Stack(RTL):
 
 class Load(Stack):
 
+    __slots__ = ()
+
     def __init__(
         self, 
         this_insn: int, 
@@ -471,10 +631,10 @@ class Load(Stack):
     ) -> None:
         super(Load, self).__init__(this_insn, basic_block, value)
 
-    def set_defs(
+    def compute_defs(
         self
-    ) -> None:
-        self.defs = self.value.get_defs()
+    ) -> Set[Register]:
+        return self.value.get_defs()
 
     def asm(
         self, 
@@ -489,7 +649,9 @@ class Load(Stack):
 
 
 class Store(Stack):
-    
+
+    __slots__ = ()
+
     def __init__(
         self, 
         this_insn: int, 
@@ -498,10 +660,10 @@ class Store(Stack):
     ) -> None:
         super(Store, self).__init__(this_insn, basic_block, value)
 
-    def set_uses(
+    def compute_uses(
         self
-    ) -> None:
-        self.uses = self.value.get_uses()
+    ) -> Set[Register]:
+        return self.value.get_uses()
 
     def asm(
         self, 
@@ -517,6 +679,8 @@ class Store(Stack):
 
 class LoopPreheader(RTL):
 
+    __slots__ = ()
+
     def __init__(
         self,
         this_insn: int, 
@@ -525,6 +689,15 @@ class LoopPreheader(RTL):
         super(LoopPreheader, self).__init__(this_insn, basic_block)
 
 
+
+# Class building each kind of top-level form the backend keeps
+INSN_CLASSES: Dict[str,Any] = dict(
+    insn=Insn,
+    jump_insn=Jump,
+    call_insn=Call,
+    code_label=Label
+)
+
 # Generates the assembly language as a string
 def generate_assembly(
     rtls: List[RTL], 
@@ -1,7 +1,6 @@
 
-from typing import List, Any, Set, Optional, Dict, cast, NewType
+from typing import List, Any, Set, Optional, Dict, Iterable, Tuple, Type as Class, NamedTuple, cast, NewType
 from enum import Enum
-from copy import deepcopy
 
 from rtl.registers import ArchitectureRegisters as AR
 
@@ -9,6 +8,31 @@ from rtl.registers import ArchitectureRegisters as AR
 RegMap = NewType('RegMap', Dict['Register','RealRegister'])
 
 
+# An rtx name split into its parts, e.g. "reg/v/f:SI" is code "reg", flags
+# ("v", "f") and mode "SI". Notes keep their kind in the mode slot, e.g.
+# "int_list:REG_BR_PROB".
+class RtxCode(NamedTuple):
+    code: str
+    flags: Tuple[str, ...]
+    mode: str
+
+
+RTX_CODES: Dict[str,RtxCode] = dict()
+
+def decode_rtx(
+    name: str
+) -> RtxCode:
+    rtx: Optional[RtxCode] = RTX_CODES.get(name)
+
+    if rtx is None:
+        code_flags, _, mode = name.partition(":")
+        code, *flags = code_flags.lower().split("/")
+        rtx = RtxCode(code, tuple(flags), mode.upper())
+        RTX_CODES[name] = rtx
+
+    return rtx
+
+
 class Type(Enum):
     SI = 1
     CC = 2
@@ -17,12 +41,12 @@ class Type(Enum):
     def translate(
         type: str
     ) -> 'Type':
-        ret = None
-        type = type.lower()
+        ret: Type
+        mode: str = decode_rtx(type).mode
 
-        if "si" in type:
-            ret = Type.SI
-        elif "cc" in type:
+        if mode in Type.__members__:
+            ret = Type[mode]
+        elif mode.startswith(Type.CC.name): # CC_NOOV, CC_Z, ...
             ret = Type.CC
         else:
             raise NotImplementedError
@@ -32,30 +56,21 @@ class Type(Enum):
 
 class Value:
 
+    __slots__ = ()
+
     @staticmethod
     def factory(
-        value_sexp: List[Any]
+        value_sexp: List[Any],
+        registers: 'RegisterTable'
     ) -> 'Value':
-        value_repr: Value
-        value_type: str = str(value_sexp[0].lower())
-
-        if "const" in value_type:
-            value_repr = Const.factory(value_sexp)
-        elif "reg" in value_type:
-            value_repr = Register.factory(value_sexp)
-        elif "mem" in value_type:
-            value_repr = Memory.factory(value_sexp)
-        elif "compare" in value_type:
-            value_repr = Compare.factory(value_sexp)
-        elif ("plus" in value_type
-                or "ashift" in value_type
-                or "mult" in value_type
-                or "minus" in value_type):
-            value_repr = Arithmetic.factory(value_sexp)
-        else:
+        value_class: Optional[Class[Value]] = VALUE_CLASSES.get(
+            decode_rtx(str(value_sexp[0])).code
+        )
+
+        if value_class is None:
             raise NotImplementedError
 
-        return value_repr
+        return value_class.factory(value_sexp, registers)
 
     def get_defs(
         self
@@ -74,16 +89,20 @@ class Value:
     ) -> str:
         pass
 
+    # Returns the value to use in place of this one once every occurrence
+    # of reg has been replaced by new_reg
     def update_virt_reg(
         self, 
         reg: 'Value', 
-        prime: int
-    ) -> None:
-        pass
+        new_reg: 'VirtualRegister'
+    ) -> 'Value':
+        return self
 
 
 class Register(Value):
 
+    __slots__ = ("reg_type", "number", "id")
+
     def __init__(
         self, 
         reg_type: Type, 
@@ -91,6 +110,8 @@ class Register(Value):
     ) -> None:
         self.reg_type: Type = reg_type
         self.number: int = number
+        # Dense id given by the RegisterTable that interned the register
+        self.id: int = -1
 
     def asm(
         self, 
@@ -108,7 +129,8 @@ class Register(Value):
 
     @staticmethod
     def factory(
-        reg_sexp: List[Any]
+        reg_sexp: List[Any],
+        registers: 'RegisterTable'
     ) -> Value:
         reg: Value
         reg_label, number_str, *rest = reg_sexp
@@ -117,14 +139,14 @@ class Register(Value):
         repr: Optional[List[Any]] = None if len(rest) == 0 else rest[0]
 
         if number == AR.CONDITION_CODES:
-            reg = ConditionCodes(reg_type, number)
+            reg = registers.intern(ConditionCodes, reg_type, number)
         elif (
             number in AR.REAL_REGISTERS_NUM
             or number == AR.ARG_POINTER
         ):
-            reg = RealRegister.factory(reg_sexp)
-        elif repr is None or isinstance(repr, List):
-            reg = VirtualRegister(reg_type, number)
+            reg = RealRegister.factory(reg_sexp, registers)
+        elif repr is None or isinstance(repr, tuple):
+            reg = registers.intern(VirtualRegister, reg_type, number)
         else:
             raise NotImplementedError
 
@@ -147,6 +169,8 @@ class Register(Value):
 
 class RealRegister(Register):
 
+    __slots__ = ("repr",)
+
     def __init__(
         self, 
         reg_type: Type, 
@@ -179,7 +203,8 @@ class RealRegister(Register):
 
     @staticmethod
     def factory(
-        reg_sexp: List[Any]
+        reg_sexp: List[Any],
+        registers: 'RegisterTable'
     ) -> Value:
         reg: Value
         reg_label, number_str, *rest = reg_sexp
@@ -188,15 +213,17 @@ class RealRegister(Register):
         repr: Optional[str] = None if len(rest) == 0 else str(rest[0])
 
         if number in AR.CALLER_SAVE_REGISTERS_NUM:
-            reg = CallerSaveRegister(reg_type, number, repr)
+            reg = registers.intern(CallerSaveRegister, reg_type, number, repr=repr)
         else:
-            reg = RealRegister(reg_type, number, repr)
+            reg = registers.intern(RealRegister, reg_type, number, repr=repr)
 
         return reg
 
 
 class CallerSaveRegister(RealRegister):
 
+    __slots__ = ()
+
     def __init__(
         self, 
         reg_type: Type, 
@@ -209,7 +236,7 @@ class CallerSaveRegister(RealRegister):
     def create_set(
         self
     ) -> Set[Register]:
-        return {deepcopy(self)}
+        return {self}
 
     def get_defs(
         self
@@ -224,6 +251,8 @@ class CallerSaveRegister(RealRegister):
 
 class ConditionCodes(Register):
 
+    __slots__ = ()
+
     def __init__(
         self, 
         reg_type: Type, 
@@ -231,14 +260,22 @@ class ConditionCodes(Register):
     ) -> None:
         super(ConditionCodes, self).__init__(reg_type, number)
 
+    # The one condition code register of a function, interned so it has an
+    # id in the function's bitsets
     @staticmethod
     def get_cc(
+        registers: 'RegisterTable'
     ) -> 'ConditionCodes':
-        return ConditionCodes(Type.CC, AR.CONDITION_CODES)
+        return cast(
+            ConditionCodes,
+            registers.intern(ConditionCodes, Type.CC, AR.CONDITION_CODES)
+        )
         
 
 class VirtualRegister(Register):
 
+    __slots__ = ("prime",)
+
     def __init__(
         self, 
         reg_type: Type, 
@@ -252,7 +289,7 @@ class VirtualRegister(Register):
     def create_set(
         self
     ) -> Set[Register]:
-        return {deepcopy(self)}
+        return {self}
 
     def get_defs(
         self
@@ -267,10 +304,9 @@ class VirtualRegister(Register):
     def update_virt_reg(
         self, 
         reg: Value, 
-        prime: int
-    ) -> None:
-        if self == reg:
-            self.prime = prime
+        new_reg: 'VirtualRegister'
+    ) -> Value:
+        return new_reg if self == reg else self
 
     def __repr__(
         self
@@ -304,6 +340,8 @@ class VirtualRegister(Register):
 
 class Const(Value):
 
+    __slots__ = ("value",)
+
     def __init__(
         self, 
         value: int
@@ -343,15 +381,18 @@ class Const(Value):
 
     @staticmethod
     def factory(
-        const_sexp: List[Any]
+        const_sexp: List[Any],
+        registers: 'RegisterTable'
     ) -> Value:
         _, value, *_ = const_sexp
 
-        return Const(value)
+        return Const(int(value))
 
 
 class Memory(Value):
 
+    __slots__ = ("mem_type", "addr")
+
     def __init__(
         self, 
         mem_type: Type, 
@@ -368,9 +409,11 @@ class Memory(Value):
     def update_virt_reg(
         self, 
         reg: Value, 
-        prime: int
-    ) -> None:
-        self.addr.update_virt_reg(reg, prime)
+        new_reg: 'VirtualRegister'
+    ) -> Value:
+        self.addr = self.addr.update_virt_reg(reg, new_reg)
+
+        return self
 
     def asm(
         self, 
@@ -383,18 +426,21 @@ class Memory(Value):
 
     @staticmethod
     def factory(
-        mem_sexp: List[Any]
+        mem_sexp: List[Any],
+        registers: 'RegisterTable'
     ) -> Value:
         mem_str, mem_addr_sexp, *_ = mem_sexp
 
         type: Type = Type.translate(str(mem_str))
-        addr: Value = Value.factory(mem_addr_sexp)
+        addr: Value = Value.factory(mem_addr_sexp, registers)
 
         return Memory(type, addr)
 
 
 class BinaryValue(Value):
 
+    __slots__ = ("result_type", "value1", "value2")
+
     def __init__(
         self, 
         result_type: Type, 
@@ -413,14 +459,18 @@ class BinaryValue(Value):
     def update_virt_reg(
         self, 
         reg: Value, 
-        prime: int
-    ) -> None:
-        self.value1.update_virt_reg(reg, prime)
-        self.value2.update_virt_reg(reg, prime)
+        new_reg: 'VirtualRegister'
+    ) -> Value:
+        self.value1 = self.value1.update_virt_reg(reg, new_reg)
+        self.value2 = self.value2.update_virt_reg(reg, new_reg)
+
+        return self
 
 
 class Compare(BinaryValue):
 
+    __slots__ = ()
+
     def __init__(
         self, 
         compare_type: Type, 
@@ -431,13 +481,14 @@ class Compare(BinaryValue):
 
     @staticmethod
     def factory(
-        compare_sexp: List[Any]
+        compare_sexp: List[Any],
+        registers: 'RegisterTable'
     ) -> Value:
         op_str, value1_sexp, value2_sexp = compare_sexp
 
         type: Type = Type.translate(str(op_str))
-        value1: Value = Value.factory(value1_sexp)
-        value2: Value = Value.factory(value2_sexp)
+        value1: Value = Value.factory(value1_sexp, registers)
+        value2: Value = Value.factory(value2_sexp, registers)
 
         return Compare(type, value1, value2)
 
@@ -454,9 +505,14 @@ class Compare(BinaryValue):
 
 class Arithmetic(BinaryValue):
 
+    __slots__ = ("arith_op",)
+
+    # Named after the rtx code, valued with the instruction
     class ArithmeticOp(Enum):
         PLUS = "add"
         ASHIFT = "lsl"
+        ASHIFTRT = "asr"
+        LSHIFTRT = "lsr"
         MULT = "mult"
         MINUS = "sub"
 
@@ -464,20 +520,12 @@ class Arithmetic(BinaryValue):
         def translate(
             op_str: str
         ) -> 'Arithmetic.ArithmeticOp':
-            ret: Arithmetic.ArithmeticOp
-
-            if "plus" in op_str:
-                ret = Arithmetic.ArithmeticOp.PLUS
-            elif "ashift" in op_str and "ashiftrt" not in op_str:
-                ret = Arithmetic.ArithmeticOp.ASHIFT
-            elif "mult" in op_str:
-                ret = Arithmetic.ArithmeticOp.MULT
-            elif "minus" in op_str:
-                ret = Arithmetic.ArithmeticOp.MINUS
-            else:
+            code: str = decode_rtx(op_str).code.upper()
+
+            if code not in Arithmetic.ArithmeticOp.__members__:
                 raise NotImplementedError
 
-            return ret
+            return Arithmetic.ArithmeticOp[code]
 
     def __init__(
         self, 
@@ -535,12 +583,106 @@ class Arithmetic(BinaryValue):
 
     @staticmethod
     def factory(
-        arith_sexp: List[Any]
+        arith_sexp: List[Any],
+        registers: 'RegisterTable'
     ) -> Value:
         op_str, value1_sexp, value2_sexp = arith_sexp
         arith_op: Arithmetic.ArithmeticOp = Arithmetic.ArithmeticOp.translate(op_str)
         arith_type: Type = Type.translate(str(op_str))
-        value1: Value = Value.factory(value1_sexp)
-        value2: Value = Value.factory(value2_sexp)
+        value1: Value = Value.factory(value1_sexp, registers)
+        value2: Value = Value.factory(value2_sexp, registers)
 
         return Arithmetic(arith_type, value1, value2, arith_op)
+
+
+
+# Class building each rtx code that can appear as a value
+VALUE_CLASSES: Dict[str,Class[Value]] = dict(
+    const_int=Const,
+    reg=Register,
+    mem=Memory,
+    compare=Compare,
+    **{op.name.lower(): Arithmetic for op in Arithmetic.ArithmeticOp}
+)
+
+
+# Interns every register of a function once and gives it a dense id, so the
+# IR and the analyses share one instance per (class, number, prime)
+class RegisterTable:
+
+    def __init__(
+        self
+    ) -> None:
+        self.registers: List[Register] = []
+        self.interned: Dict[Tuple[Class[Register],int,int],Register] = dict()
+
+        # The real registers come first so their id is their number
+        for number in sorted(AR.REAL_REGISTERS_NUM):
+            if number in AR.CALLER_SAVE_REGISTERS_NUM:
+                self.intern(CallerSaveRegister, Type.SI, number, repr=None)
+            else:
+                self.intern(RealRegister, Type.SI, number, repr=None)
+
+    def intern(
+        self, 
+        reg_class: Class[Register], 
+        reg_type: Type, 
+        number: int, 
+        prime: int = 0, 
+        **kwargs: Any
+    ) -> Register:
+        key: Tuple[Class[Register],int,int] = (reg_class, number, prime)
+        reg: Optional[Register] = self.interned.get(key)
+
+        if reg is None:
+            if prime != 0:
+                kwargs["prime"] = prime
+            reg = reg_class(reg_type, number, **kwargs)
+            reg.id = len(self.registers)
+            self.registers.append(reg)
+            self.interned[key] = reg
+
+        return reg
+
+    def __getitem__(
+        self, 
+        id: int
+    ) -> Register:
+        return self.registers[id]
+
+    # Bitset of interned registers, bit i standing for the register with id i
+    @staticmethod
+    def mask(
+        regs: Iterable[Register]
+    ) -> int:
+        mask: int = 0
+        for reg in regs:
+            assert(reg.id >= 0)
+            mask |= 1 << reg.id
+
+        return mask
+
+    # The ids set in a bitset, in increasing order
+    @staticmethod
+    def ids(
+        mask: int
+    ) -> List[int]:
+        ids: List[int] = []
+        while mask != 0:
+            low: int = mask & -mask
+            ids.append(low.bit_length() - 1)
+            mask ^= low
+
+        return ids
+
+    # The registers of a bitset, in id order
+    def members(
+        self,
+        mask: int
+    ) -> List[Register]:
+        return [self.registers[id] for id in RegisterTable.ids(mask)]
+
+    def __len__(
+        self
+    ) -> int:
+        return len(self.registers)
@@ -4,6 +4,7 @@ from queue import PriorityQueue
 from graph import *
 from rtl import *
 from rtl.value import Memory
+from order import OrderedList
 
 MEM_LATENCY = 4
 DEF_USE_LATENCY = 1
@@ -203,46 +204,36 @@ class Graph:
         return node in self.__node_to_row
 
 
-# Divides code into basic blocks
+# Reschedules the instructions of every basic block
 def bb_instruction_schedule(
-    vertices: List[Vertex], 
+    blocks: List[Block], 
     register_mapping: Optional[RegMap]=None
 ) -> None:
-    init_length: int = len(vertices)
-
-    idx: int = 0
-    basic_block: int = -1
-    first_bb: int = -1
-
-    for vertex in vertices:
-        vertex.rtl.set_defs()
-        vertex.rtl.set_uses()
-        vertex.rtl.set_defs_reg(register_mapping)
-        vertex.rtl.set_uses_reg(register_mapping)
-
-    while idx < len(vertices):
-        if basic_block == -1:
-            basic_block = vertices[idx].rtl.basic_block
-            first_bb = idx
-            idx += 1
-        elif basic_block != vertices[idx].rtl.basic_block:
-            local_instruction_schedule(vertices, first_bb, idx - 1)
-            assert(init_length == len(vertices))
-            basic_block = -1
-        else:
-            idx += 1
+    block: Block
+
+    if register_mapping is not None:
+        for block in blocks:
+            for rtl in block.rtls:
+                rtl.set_defs_reg(register_mapping)
+                rtl.set_uses_reg(register_mapping)
+
+    for block in blocks:
+        rtls: List[RTL] = list(block.rtls)
+        local_instruction_schedule(rtls, 0, len(rtls) - 1)
+        assert(len(rtls) == len(block.rtls))
+        block.rtls.splice(None, rtls)
 
 
 # Builds the DAG for a basic block and reschedules the instructions
 def local_instruction_schedule(
-    vertices: List[Vertex], 
+    rtls: List[RTL], 
     start: int, 
     end: int
 ) -> None:
 
-    if isinstance(vertices[start].rtl, Label):
+    if isinstance(rtls[start], Label):
         start += 1
-    if isinstance(vertices[end].rtl, Jump):
+    if isinstance(rtls[end], Jump):
         end -= 1
 
     curr_defs: Set[Register]
@@ -258,19 +249,19 @@ def local_instruction_schedule(
 
     for idx1 in range(start, end + 1):
 
-        mem = ((isinstance(vertices[idx1].rtl, SetInsn)
-                and isinstance(cast(SetInsn, vertices[idx1].rtl).use_value, Memory))
-               or isinstance(vertices[idx1].rtl, Load))
+        mem = ((isinstance(rtls[idx1], SetInsn)
+                and isinstance(cast(SetInsn, rtls[idx1]).use_value, Memory))
+               or isinstance(rtls[idx1], Load))
 
-        curr_defs = vertices[idx1].rtl.defs
-        if isinstance(vertices[idx1].rtl, Call):
+        curr_defs = rtls[idx1].defs
+        if isinstance(rtls[idx1], Call):
             curr_defs = curr_defs.union(CALLER_SAVE_REGISTERS)
 
         idx2 = idx1 - 1
         while idx2 >= start and len(curr_defs) > 0:
-            next_defs = vertices[idx2].rtl.defs
-            next_uses = vertices[idx2].rtl.uses
-            if isinstance(vertices[idx2].rtl, Call):
+            next_defs = rtls[idx2].defs
+            next_uses = rtls[idx2].uses
+            if isinstance(rtls[idx2], Call):
                 next_defs = next_defs.union(CALLER_SAVE_REGISTERS)
                 next_uses = next_uses.union(CALLER_SAVE_REGISTERS)
 
@@ -279,15 +270,15 @@ def local_instruction_schedule(
             curr_defs = curr_defs.difference(next_defs)
             idx2 -= 1
 
-        curr_defs = vertices[idx1].rtl.defs
-        if isinstance(vertices[idx1].rtl, Call):
+        curr_defs = rtls[idx1].defs
+        if isinstance(rtls[idx1], Call):
             curr_defs = curr_defs.union(CALLER_SAVE_REGISTERS)
 
         idx2 = idx1 + 1
         while idx2 <= end and len(curr_defs) > 0:
-            next_defs = vertices[idx2].rtl.defs
-            next_uses = vertices[idx2].rtl.uses
-            if isinstance(vertices[idx2].rtl, Call):
+            next_defs = rtls[idx2].defs
+            next_uses = rtls[idx2].uses
+            if isinstance(rtls[idx2], Call):
                 next_defs = next_defs.union(CALLER_SAVE_REGISTERS)
                 next_uses = next_uses.union(CALLER_SAVE_REGISTERS)
 
@@ -300,90 +291,99 @@ def local_instruction_schedule(
             idx2 += 1
 
     matrix.heuristics()
-    vertices[start : end + 1] = [vertices[idx] for idx in matrix.schedule()]
+    rtls[start : end + 1] = [rtls[idx] for idx in matrix.schedule()]
 
 
+# Schedules the hottest trace, returns the new instruction order and the trace
 def trace_schedule(
-    vertices: List[Vertex]
-) -> List[RTL]:
-
-    for vertex in vertices:
-        vertex.visited = False
-
-    trace: List[Vertex] = get_trace(vertices)
-    joins: Dict[Vertex, Set[Register]] = dict()
-    splits: Dict[Vertex, Set[Register]] = dict()
-    for vertex in trace:
-        if len(vertex.in_edges) > 1:
-            live_out: Set[Register] = set()
-            for edge in vertex.in_edges:
-                if edge.start not in trace:
-                    live_out = live_out.union(edge.start.live_out)
-            joins[vertex] = live_out
-        if len(vertex.out_edges) > 1:
-            live_in: Set[Register] = set()
-            for edge in vertex.out_edges:
-                if edge.end not in trace:
-                    live_in = live_in.union(edge.end.live_in)
-            splits[vertex] = live_in
-    before: List[Vertex] = vertices[ : vertices.index(trace[0])]
-    after: List[Vertex] = vertices[vertices.index(trace[-1]) : ]
-    gaps: Dict[Tuple[Vertex, Vertex], List[Vertex]] = dict()
+    blocks: List[Block],
+    registers: RegisterTable
+) -> Tuple[List[RTL], List[RTL]]:
+
+    for block in blocks:
+        block.visited = False
+
+    # The trace is picked over blocks and scheduled over instructions
+    rtls: OrderedList[RTL] = instructions(blocks)
+    trace: List[RTL] = get_trace(blocks, rtls)
+    in_trace: Set[RTL] = set(trace)
+    joins: Dict[RTL, Set[Register]] = dict()
+    splits: Dict[RTL, Set[Register]] = dict()
+    for block in blocks:
+        if block.first in in_trace and len(block.in_edges) > 1:
+            live_out: int = 0
+            for edge in block.in_edges:
+                if edge.start.last not in in_trace:
+                    live_out |= edge.start.live_out
+            joins[block.first] = set(registers.members(live_out))
+        if block.last in in_trace and len(block.out_edges) > 1:
+            live_in: int = 0
+            for edge in block.out_edges:
+                if edge.end.first not in in_trace:
+                    live_in |= edge.end.live_in
+            splits[block.last] = set(registers.members(live_in))
+    gaps: Dict[Tuple[RTL, RTL], List[RTL]] = dict()
     for idx1 in range(len(trace) - 1):
         idx2: int = idx1 + 1
-        v_idx1: int = vertices.index(trace[idx1])
-        v_idx2: int = vertices.index(trace[idx2])
-        if v_idx1 + 1 != v_idx2:
-            gaps[(trace[idx1], trace[idx2])] = vertices[v_idx1 + 1 : v_idx2]
+        if rtls.next(trace[idx1]) is not trace[idx2]:
+            gaps[(trace[idx1], trace[idx2])] = rtls.between(
+                rtls.next(trace[idx1]), trace[idx2]
+            )
     
-    schedule: List[Vertex] = trace_schedule_(trace, joins, splits)
+    schedule: List[RTL] = trace_schedule_(trace, joins, splits, registers)
 
-    new_vertices: List[Vertex] = before
-    for idx1 in range(len(schedule) - 1):
-        idx2: int = idx1 + 1
-        new_vertices.append(schedule[idx1])
-        if (schedule[idx1], schedule[idx2]) in gaps:
-            new_vertices += gaps[(schedule[idx1], schedule[idx2])]
-    new_vertices += after
+    # Splice the schedule in where the trace was, keeping each gap after
+    # the instruction it followed
+    cursor: Optional[RTL] = rtls.prev(trace[0])
+    gap: List[RTL]
+    for idx1 in range(len(schedule)):
+        rtls.splice(cursor, [schedule[idx1]])
+        cursor = schedule[idx1]
+        if idx1 + 1 < len(schedule) and (schedule[idx1], schedule[idx1 + 1]) in gaps:
+            gap = gaps[(schedule[idx1], schedule[idx1 + 1])]
+            rtls.splice(cursor, gap)
+            cursor = gap[-1]
 
-    return [vertex.rtl for vertex in new_vertices]
+    return list(rtls), trace
 
 
 def get_trace(
-    vertices: List[Vertex]
-) -> List[Vertex]:
-    trace: List[Vertex] = list()
+    blocks: List[Block],
+    rtls: OrderedList[RTL]
+) -> List[RTL]:
+    trace: List[RTL] = list()
+
+    max_block: Block = blocks[0]
+    max_expect: float = blocks[0].expect
+    for block in blocks[1 : ]:
+        if block.expect > max_expect:
+            max_expect = block.expect
+            max_block = block
 
-    max_vertex: Vertex = vertices[0]
-    max_expect: float = vertices[0].expect
-    for vertex in vertices[1 : ]:
-        if vertex.expect > max_expect:
-            max_expect = vertex.expect
-            max_vertex = vertex
+    start: Block = max_block
 
-    start: Vertex = max_vertex
+    current: Block = start
 
-    current: Vertex = start
+    # Straight-line code always follows the start of its block
+    trace += start.rtls.between(start.rtls.next(start.first), None)
 
     # Go forward
     while True:
         for edge in current.out_edges:
-            if any(
-                [isinstance(next_edge.start.rtl, LoopPreheader) for next_edge in edge.end.in_edges]
-            ):
+            if edge.end.is_header:
                 break
         else:
-            best_next: Optional[Vertex] = None
+            best_next: Optional[Block] = None
             best_expect: float = -1.0
             for edge in current.out_edges:
                 if edge.end.expect > best_expect:
                     best_expect = edge.end.expect
                     best_next = edge.end
             if best_next is not None:
-                best_next_v: Vertex = cast(Vertex, best_next)
-                if best_next_v.expects[current] >= max(best_next_v.expects.values()):
-                    current = best_next_v
-                    trace.append(current)
+                best_next_b: Block = cast(Block, best_next)
+                if best_next_b.expects[current] >= max(best_next_b.expects.values()):
+                    current = best_next_b
+                    trace += current.rtls
                     continue
                 else:
                     break
@@ -397,17 +397,17 @@ def get_trace(
             if edge.start.loop > current.loop:
                 break
         else:
-            trace.append(current)
-            best_prev: Optional[Vertex] = None
+            trace.append(current.first)
+            best_prev: Optional[Block] = None
             best_expect: float = -1.0
             for edge in current.in_edges:
                 if edge.start.expect > best_expect:
                     best_expect = edge.start.expect
                     best_next = edge.start
             if best_prev is not None:
-                best_prev_v: Vertex = cast(Vertex, best_prev)
-                if current.expects[best_prev_v] >= max(current.expects.values()):
-                    current = best_prev_v
+                best_prev_b: Block = cast(Block, best_prev)
+                if current.expects[best_prev_b] >= max(current.expects.values()):
+                    current = best_prev_b
                     continue
                 else:
                     break
@@ -415,85 +415,90 @@ def get_trace(
                 break
         break
 
-    return sorted(trace, key=lambda v: vertices.index(v))
+    return sorted(trace, key=rtls.position_of)
 
 
 def trace_schedule_(
-    trace: List[Vertex],
-    joins: Dict[Vertex, Set[Register]],
-    splits: Dict[Vertex, Set[Register]]
-) -> List[Vertex]:
+    trace: List[RTL],
+    joins: Dict[RTL, Set[Register]],
+    splits: Dict[RTL, Set[Register]],
+    registers: RegisterTable
+) -> List[RTL]:
     matrix: Graph = Graph(directed=True)
-
-    for vertex in trace:
-        vertex.rtl.set_defs()
-        vertex.rtl.set_uses()
+    cc: ConditionCodes = ConditionCodes.get_cc(registers)
 
     for idx in range(len(trace)):
         matrix.add_node(idx)
 
-    for idx, vertex in enumerate(trace):
+    for idx, rtl in enumerate(trace):
         
         mem: bool = (
-            (isinstance(vertex.rtl, SetInsn)
-            and isinstance(cast(SetInsn, vertex.rtl).use_value, Memory))
-            or isinstance(vertex.rtl, Load)
+            (isinstance(rtl, SetInsn)
+            and isinstance(cast(SetInsn, rtl).use_value, Memory))
+            or isinstance(rtl, Load)
         )
-        is_join: bool = vertex in joins
-        is_split: bool = vertex in splits
+        is_join: bool = rtl in joins
+        is_split: bool = rtl in splits
         b_branch: bool = (
-            isinstance(vertex.rtl, Jump) and 
-            not isinstance(vertex.rtl, ConditionalJump)
+            isinstance(rtl, Jump) and 
+            not isinstance(rtl, ConditionalJump)
         )
 
-        curr_defs: Set[Register] = vertex.rtl.defs
-        if isinstance(vertex.rtl, Call):
+        curr_defs: Set[Register] = rtl.defs
+        if isinstance(rtl, Call):
             curr_defs = curr_defs.union(CALLER_SAVE_REGISTERS)
-        elif isinstance(vertex.rtl, Compare):
-            curr_defs = curr_defs.union({ConditionCodes.get_cc()})
+        elif isinstance(rtl, Compare):
+            curr_defs = curr_defs.union({cc})
 
         idx_prime: int = idx - 1
         while idx_prime >= 0:
-            next_defs = trace[idx_prime].rtl.defs
-            next_uses = trace[idx_prime].rtl.uses
-            if isinstance(trace[idx_prime].rtl, Call):
+            next_defs = trace[idx_prime].defs
+            next_uses = trace[idx_prime].uses
+            if isinstance(trace[idx_prime], Call):
                 next_defs = next_defs.union(CALLER_SAVE_REGISTERS)
                 next_uses = next_uses.union(CALLER_SAVE_REGISTERS)
-            elif isinstance(trace[idx_prime].rtl, Compare):
-                next_defs = next_defs.union({ConditionCodes.get_cc()})
-            elif isinstance(trace[idx_prime].rtl, ConditionalJump):
-                next_uses = next_uses.union({ConditionCodes.get_cc()})
+            elif isinstance(trace[idx_prime], Compare):
+                next_defs = next_defs.union({cc})
+            elif isinstance(trace[idx_prime], ConditionalJump):
+                next_uses = next_uses.union({cc})
 
             if (
                 len(curr_defs.intersection(next_uses)) != 0 or is_split or 
-                (is_join and len(next_defs.intersection(joins[vertex])) > 0) or 
+                (is_join and len(next_defs.intersection(joins[rtl])) > 0) or 
                 b_branch
             ):
                 matrix.add_edge(idx_prime, idx, ANTI_LATENCY)
             curr_defs = curr_defs.difference(next_defs)
             idx_prime -= 1
 
-        curr_defs = vertex.rtl.defs
-        if isinstance(vertex.rtl, Call):
+        curr_defs = rtl.defs
+        if isinstance(rtl, Call):
             curr_defs = curr_defs.union(CALLER_SAVE_REGISTERS)
-        elif isinstance(vertex.rtl, Compare):
-            curr_defs = curr_defs.union({ConditionCodes.get_cc()})
+        elif isinstance(rtl, Compare):
+            curr_defs = curr_defs.union({cc})
 
-        for idx_prime, vertex_prime in enumerate(trace[idx + 1: ], idx + 1):
-            next_defs = vertex_prime.rtl.defs
-            next_uses = vertex_prime.rtl.uses
+        for idx_prime, rtl_prime in enumerate(trace[idx + 1: ], idx + 1):
+            next_defs = rtl_prime.defs
+            next_uses = rtl_prime.uses
             is_store: bool = (
-                (isinstance(vertex_prime.rtl, SetInsn)
-                and isinstance(cast(SetInsn, vertex_prime.rtl).def_value, Memory))
-                or isinstance(vertex_prime.rtl, Store)
+                (isinstance(rtl_prime, SetInsn)
+                and isinstance(cast(SetInsn, rtl_prime).def_value, Memory))
+                or isinstance(rtl_prime, Store)
+            )
+            # A load hoisted above a split may read past the data the
+            # off-trace path stops at, so it stays below like a store
+            is_load: bool = (
+                (isinstance(rtl_prime, SetInsn)
+                and isinstance(cast(SetInsn, rtl_prime).use_value, Memory))
+                or isinstance(rtl_prime, Load)
             )
-            if isinstance(vertex_prime.rtl, Call):
+            if isinstance(rtl_prime, Call):
                 next_defs = next_defs.union(CALLER_SAVE_REGISTERS)
                 next_uses = next_uses.union(CALLER_SAVE_REGISTERS)
-            elif isinstance(vertex_prime.rtl, Compare):
-                next_defs = next_defs.union({ConditionCodes.get_cc()})
-            elif isinstance(vertex_prime.rtl, ConditionalJump):
-                next_uses = next_uses.union({ConditionCodes.get_cc()})
+            elif isinstance(rtl_prime, Compare):
+                next_defs = next_defs.union({cc})
+            elif isinstance(rtl_prime, ConditionalJump):
+                next_uses = next_uses.union({cc})
 
             if len(curr_defs.intersection(next_uses)) != 0:
                 matrix.add_edge(
@@ -501,8 +506,8 @@ def trace_schedule_(
                     MEM_LATENCY if mem else DEF_USE_LATENCY
                 )
             elif (
-                is_join or (is_split and is_store) or 
-                (is_split and len(curr_defs.intersection(splits[vertex])) > 0) or
+                is_join or (is_split and (is_store or is_load)) or 
+                (is_split and len(curr_defs.intersection(splits[rtl])) > 0) or
                 b_branch
             ):
                 matrix.add_edge(idx, idx_prime, ANTI_LATENCY)
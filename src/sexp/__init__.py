@@ -1,5 +1,7 @@
 
 import re
+import mmap
+from itertools import groupby
  
 
 dbg = False
@@ -14,6 +16,26 @@ term_regex = r'''(?mx)
         (?P<sq>"[^"]*")|
         (?P<s>[^(^)\s]+)
        )'''
+term_re = re.compile(term_regex)
+
+# Same grammar over raw bytes, with square brackets tokenized as brackets
+term_bytes_re = re.compile(rb'''(?x)
+    \s*(?:
+        (?P<brackl>[(\[])|
+        (?P<brackr>[)\]])|
+        (?P<hex>0[xX][0-9a-fA-F]+)|
+        (?P<num>\-?\d+\.\d+|\-?\d+)|
+        (?P<sq>"[^"]*")|
+        (?P<s>[^(^)\[\]\s]+)
+       )''')
+form_start_re = re.compile(rb'^[(]', re.M)
+# Leading rtx code of a form, without flags or mode, and the tokens that
+# change the bracket depth
+form_code_re = re.compile(r'\s*([^(^)\[\]\s:/]+)')
+form_code_bytes_re = re.compile(rb'\s*([^(^)\[\]\s:/]+)')
+bracket_re = re.compile(rb'[(\[]|[)\]]|"[^"]*"')
+
+FUNCTION_HEADER = ";; Function "
  
 
 def parse_sexp(sexp):
@@ -48,7 +70,7 @@ def parse_sexp(sexp):
 
 def print_sexp(exp):
     out = ''
-    if type(exp) == type([]):
+    if isinstance(exp, (list, tuple)):
         out += '(' + ' '.join(print_sexp(x) for x in exp) + ')'
     elif type(exp) == type('') and re.search(r'[\s()]', exp):
         out += '"%s"' % repr(exp)[1:-1].replace('"', '\"')
@@ -57,31 +79,174 @@ def print_sexp(exp):
     return out
 
 
-def read_sexp(file_name):
-    line = ""
-    rtl_exprs = []
+def iter_sexp(lines, codes=None):
+    # Incrementally tokenize the lines, yielding each top-level form as soon
+    # as its closing bracket is seen so no text is ever tokenized twice.
+    # Top-level forms whose rtx code is not in codes are skipped unparsed.
+    # Forms are tuples and atoms stay strings, numbers included; equal atoms
+    # share one string.
+    stack = []
+    out = []
+    atoms = {}
+    skip = 0
+    for line in lines:
+        if skip > 0:
+            text = line.encode()
+            _, skip = skip_brackets(text, 0, len(text), skip)
+            continue
+        if not stack and line[ : 1] != '(':
+            continue
+        if not stack and codes is not None:
+            code = form_code_re.match(line, 1)
+            if code is not None and code.group(1).lower() not in codes:
+                text = line.encode()
+                _, skip = skip_brackets(text, 0, len(text), 0)
+                continue
+        line = line.replace('[', '(').replace(']', ')')
+        for termtypes in term_re.finditer(line):
+            term = termtypes.lastgroup
+            if term == 'brackl':
+                stack.append(out)
+                out = []
+            elif term == 'brackr':
+                assert stack, "Trouble with nesting of brackets"
+                tmpout, out = tuple(out), stack.pop(-1)
+                if stack:
+                    out.append(tmpout)
+                else:
+                    yield tmpout
+            elif stack:
+                value = termtypes.group(term)
+                atom = atoms.get(value)
+                if atom is None:
+                    atom = atoms[value] = value[1:-1] if term == 'sq' else value
+                out.append(atom)
+    assert not stack and skip == 0, "Trouble with nesting of brackets"
+
+
+# Counts brackets from depth until the depth returns to zero. Returns the
+# offset just past the closing bracket and the remaining depth, which is
+# only non-zero when end is reached first.
+def skip_brackets(buffer, start, end, depth):
+    for bracket in bracket_re.finditer(buffer, start, end):
+        token = bracket.group()
+        if token in b"([":
+            depth += 1
+        elif token in b")]":
+            depth -= 1
+            if depth == 0:
+                return bracket.end(), depth
+    return end, depth
 
-    with open(file_name, "r") as in_file:
-        func_name = ""
-        # Read past the garbage at the beginning
-        line = in_file.readline()
-        while line[0] != '(' and line != "":
-            line = line.lower().split()
-            if "function" in line:
-                if "void" in line:
-                    func_name = line[line.index("void") + 1].split("(")[0]
+
+def function_name(header):
+    # ";; Function void foo(int) (_Z3fooi, ...)" or ";; Function foo (foo, ...)"
+    decl = header[len(FUNCTION_HEADER) : ].split("(")[0].split()
+    return decl[-1] if decl else ""
+
+
+def scan_sexp(buffer, start=0, end=None, codes=None):
+    # One pass of a single compiled tokenizer over the buffer. Top-level
+    # forms whose rtx code is not in codes are stepped over by counting
+    # brackets, without building them. Forms are tuples and atoms stay
+    # strings, numbers included, decoded once per distinct atom.
+    stack = []
+    out = []
+    atoms = {}
+    if end is None: end = len(buffer)
+    if codes is not None: codes = set(code.encode() for code in codes)
+    pos = start
+    while pos < end:
+        for termtypes in term_bytes_re.finditer(buffer, pos, end):
+            term = termtypes.lastgroup
+            if term == 'brackl':
+                if not stack and codes is not None:
+                    code = form_code_bytes_re.match(buffer, termtypes.end(), end)
+                    if code is not None and code.group(1).lower() not in codes:
+                        pos, depth = skip_brackets(buffer, termtypes.end(), end, 1)
+                        assert depth == 0, "Trouble with nesting of brackets"
+                        break
+                stack.append(out)
+                out = []
+            elif term == 'brackr':
+                assert stack, "Trouble with nesting of brackets"
+                tmpout, out = tuple(out), stack.pop(-1)
+                if stack:
+                    out.append(tmpout)
                 else:
-                    func_name = line[line.index("function") + 1].split("(")[0]
-            line = in_file.readline()
+                    yield tmpout
+            elif stack:
+                value = termtypes.group(term)
+                atom = atoms.get(value)
+                if atom is None:
+                    atom = atoms[value] = (
+                        value[1:-1] if term == 'sq' else value
+                    ).decode()
+                out.append(atom)
+        else:
+            pos = end
+    assert not stack, "Trouble with nesting of brackets"
+
+
+def split_functions(buffer):
+    # Offsets of every ";; Function" section, in source order
+    header = FUNCTION_HEADER.encode()
+    sections = []
+    start = buffer.find(header)
+    while start > 0 and buffer[start - 1 : start] != b"\n":
+        start = buffer.find(header, start + 1)
+    while start != -1:
+        eol = buffer.find(b"\n", start)
+        if eol == -1: eol = len(buffer)
+        end = buffer.find(b"\n" + header, eol)
+        end = len(buffer) if end == -1 else end + 1
+        sections.append(
+            (function_name(buffer[start : eol].decode()), eol, end)
+        )
+        start = -1 if end == len(buffer) else end
+
+    if not sections:
+        sections.append(("", 0, len(buffer)))
+
+    return sections
+
 
-        while line != "":
-            line = line.replace('[', '(').replace(']', ')')
+def read_sexp_buffer(buffer, codes=None):
+    for func_name, start, end in split_functions(buffer):
+        first_form = form_start_re.search(buffer, start, end)
+        if first_form is not None:
+            yield func_name, scan_sexp(buffer, first_form.start(), end, codes)
+
+
+def read_sexp_lines(file_name, codes=None):
+    section = [0, ""]
+
+    def header(line):
+        if line.startswith(FUNCTION_HEADER):
+            section[0] += 1
+            section[1] = function_name(line)
+        return section[0]
+
+    with open(file_name, "r") as in_file:
+        for _, lines in groupby(in_file, header):
+            yield section[1], iter_sexp(lines, codes)
+
+
+# Yields the name and a lazy stream of top-level forms for each function of
+# the dump, in source order. Each stream must be consumed before the next
+# function is requested. When codes is given, only the top-level forms with
+# one of those rtx codes are built.
+def read_sexp(file_name, use_mmap=True, codes=None):
+    buffer = None
+    if use_mmap:
+        with open(file_name, "rb") as in_file:
             try:
-                rtl_exprs.append(parse_sexp(line))
-                line = ""
-            except AssertionError:
+                buffer = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError: # Empty files cannot be mapped
                 pass
 
-            line += in_file.readline()
-    
-    return func_name, rtl_exprs
+    if buffer is None:
+        yield from read_sexp_lines(file_name, codes)
+    else:
+        with buffer:
+            yield from read_sexp_buffer(buffer, codes)